@@ -0,0 +1,17 @@
+"""Packs ImageNet into a few large tar shards next to the dataset, which ImageNetDataset extracts
+in parallel instead of copying 1.2M files one by one."""
+import argparse
+import os
+from dataset import write_imagenet_archives
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('imagenet_path', type=str, help='Directory containing the train/ and test/ folders.')
+    parser.add_argument('--archive_path', type=str, default=None, help='Defaults to {imagenet_path}/archives.')
+    parser.add_argument('--classes_per_archive', type=int, default=50)
+    parser.add_argument('--num_workers', type=int, default=8)
+    args = parser.parse_args()
+
+    archive_path = args.archive_path or os.path.join(args.imagenet_path, 'archives')
+    write_imagenet_archives(args.imagenet_path, archive_path, args.classes_per_archive, args.num_workers)
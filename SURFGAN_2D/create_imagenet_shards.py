@@ -0,0 +1,90 @@
+"""Decodes every ImageNet training JPEG once and writes it, resized to every phase resolution, to
+per-resolution TFRecord shards of raw uint8 pixels. Read them with --dataset imagenet_shards."""
+import argparse
+import glob
+import json
+import os
+import numpy as np
+import tensorflow as tf
+from tensorflow.data.experimental import AUTOTUNE
+from dataset import imagenet_classes, SHARD_INDEX
+
+
+def write_shards(imagenet_dir, output_dir, sizes, num_classes, examples_per_shard, seed=42):
+    classes = imagenet_classes(imagenet_dir, num_classes)
+    examples = []
+    for i, label in enumerate(classes):
+        examples += [(f, i) for f in sorted(glob.glob(os.path.join(imagenet_dir, 'train', label) + '/*.JPEG'))]
+
+    # Shuffle once up front so that every shard holds a mix of classes.
+    np.random.RandomState(seed).shuffle(examples)
+    paths, labels = zip(*examples)
+    print(f"Writing {len(paths)} examples of {len(classes)} classes at sizes {sizes}")
+
+    def load(path, label):
+        # Same decode and resize as dataset.imagenet_dataset, done once for all resolutions.
+        x = tf.image.decode_jpeg(tf.io.read_file(path), channels=3)
+        images = tuple(tf.cast(tf.clip_by_value(tf.round(tf.image.resize(x, [size, size])), 0, 255), tf.uint8)
+                       for size in sizes)
+        return images, label
+
+    dataset = tf.data.Dataset.from_tensor_slices((list(paths), list(labels)))
+    dataset = dataset.map(load, num_parallel_calls=AUTOTUNE)
+    dataset = dataset.prefetch(AUTOTUNE)
+    next_example = dataset.make_one_shot_iterator().get_next()
+
+    indices = {size: {'size': size, 'num_classes': len(classes), 'classes': classes, 'shards': []}
+               for size in sizes}
+    writers = {}
+    for size in sizes:
+        os.makedirs(os.path.join(output_dir, f'{size}x{size}'), exist_ok=True)
+
+    def open_shard(size):
+        shard = {'file': f"train-{len(indices[size]['shards']):05}.tfrecord", 'num_examples': 0}
+        indices[size]['shards'].append(shard)
+        writers[size] = tf.io.TFRecordWriter(os.path.join(output_dir, f'{size}x{size}', shard['file']))
+
+    with tf.Session() as sess:
+        num_examples = 0
+        while True:
+            try:
+                images, label = sess.run(next_example)
+            except tf.errors.OutOfRangeError:
+                break
+
+            for size, image in zip(sizes, images):
+                if num_examples % examples_per_shard == 0:
+                    if size in writers:
+                        writers[size].close()
+                    open_shard(size)
+
+                example = tf.train.Example(features=tf.train.Features(feature={
+                    'image': tf.train.Feature(bytes_list=tf.train.BytesList(value=[image.tobytes()])),
+                    'label': tf.train.Feature(int64_list=tf.train.Int64List(value=[int(label)])),
+                }))
+                writers[size].write(example.SerializeToString())
+                indices[size]['shards'][-1]['num_examples'] += 1
+
+            num_examples += 1
+            if num_examples % 10000 == 0:
+                print(f"{num_examples} / {len(paths)}")
+
+    for size in sizes:
+        writers[size].close()
+        with open(os.path.join(output_dir, f'{size}x{size}', SHARD_INDEX), 'w') as f:
+            json.dump(indices[size], f)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser()
+    parser.add_argument('imagenet_path', type=str, help='Directory containing the train/ and test/ folders.')
+    parser.add_argument('output_path', type=str)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128, 256])
+    parser.add_argument('--num_classes', type=int, default=1,
+                        help='Number of classes to write, should match --num_labels of main.py.')
+    parser.add_argument('--examples_per_shard', type=int, default=8192)
+    parser.add_argument('--seed', type=int, default=42)
+    args = parser.parse_args()
+
+    write_shards(args.imagenet_path, args.output_path, args.sizes, args.num_classes, args.examples_per_shard,
+                 seed=args.seed)
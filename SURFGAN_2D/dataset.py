@@ -1,93 +1,229 @@
 import glob
+import json
 import numpy as np
 from skimage import io, transform
 import os
 import shutil
+import socket
+import tarfile
 import time
+from concurrent.futures import ThreadPoolExecutor
 import tensorflow as tf
 from tensorflow.data.experimental import AUTOTUNE
 import horovod.tensorflow as hvd
 
 
+SHARD_INDEX = 'index.json'
+
+
+def imagenet_classes(imagenet_dir, num_classes):
+    """The first `num_classes` classes, sorted, that are in both the train and the test folder."""
+    train_folder = os.path.join(imagenet_dir, 'train')
+    test_folder = os.path.join(imagenet_dir, 'test')
+
+    classes_train = set(d for d in os.listdir(train_folder) if os.path.isdir(os.path.join(train_folder, d)))
+    classes_test = set(d for d in os.listdir(test_folder) if os.path.isdir(os.path.join(test_folder, d)))
+    return sorted(list(classes_train.intersection(classes_test)))[:num_classes]
+
+
+FILE_INDEX = 'file_index.json'
+ARCHIVE_INDEX = 'archives.json'
+STAGING_COMPLETE = '.staging_complete'
+
+
+def write_json(path, obj):
+    # The temporary name is unique per process, so concurrent writers never replace each other's file.
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def list_class_folder(folder):
+    return sorted(e.name for e in os.scandir(folder) if e.name.endswith('.JPEG'))
+
+
+def read_file_index(imagenet_dir, fallback_dir=None):
+    for index_dir in (imagenet_dir, fallback_dir):
+        if index_dir is not None and os.path.isfile(os.path.join(index_dir, FILE_INDEX)):
+            with open(os.path.join(index_dir, FILE_INDEX)) as f:
+                return json.load(f)
+    return None
+
+
+def imagenet_file_index(imagenet_dir, fallback_dir=None, num_workers=32, build=True, max_interval=5):
+    """Lists the classes and the JPEGs of every class folder, one folder per thread.
+
+    The result is cached in `imagenet_dir`, or in `fallback_dir` if `imagenet_dir` is read-only,
+    so the listing is done only once. With `build=False` the folders are never listed; instead
+    this blocks until the process that does build the index has written it.
+    """
+    index = read_file_index(imagenet_dir, fallback_dir)
+    if index is not None:
+        return index
+
+    if not build:
+        interval = .1
+        while index is None:
+            time.sleep(interval)
+            interval = min(2 * interval, max_interval)
+            index = read_file_index(imagenet_dir, fallback_dir)
+        return index
+
+    classes = imagenet_classes(imagenet_dir, None)
+    index = {'classes': classes}
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        for split in ('train', 'test'):
+            folders = [os.path.join(imagenet_dir, split, label) for label in classes]
+            index[split] = dict(zip(classes, pool.map(list_class_folder, folders)))
+
+    index_dir = imagenet_dir if os.access(imagenet_dir, os.W_OK) or fallback_dir is None else fallback_dir
+    os.makedirs(index_dir, exist_ok=True)
+    write_json(os.path.join(index_dir, FILE_INDEX), index)
+    return index
+
+
+def write_imagenet_archives(imagenet_dir, archive_dir, classes_per_archive=50, num_workers=8):
+    """Packs the dataset into tar shards of `classes_per_archive` consecutive classes, so that the
+    first `num_classes` classes can be staged by extracting only the first few shards."""
+    index = imagenet_file_index(imagenet_dir)
+    classes = index['classes']
+    os.makedirs(archive_dir, exist_ok=True)
+
+    def write(i):
+        shard_classes = classes[i * classes_per_archive: (i + 1) * classes_per_archive]
+        name = f'shard-{i:04}.tar'
+        with tarfile.open(os.path.join(archive_dir, name), 'w') as tar:
+            for split in ('train', 'test'):
+                for label in shard_classes:
+                    for f in index[split][label]:
+                        tar.add(os.path.join(imagenet_dir, split, label, f), arcname=os.path.join(split, label, f))
+        return {'file': name, 'classes': shard_classes}
+
+    num_archives = (len(classes) + classes_per_archive - 1) // classes_per_archive
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        archives = list(pool.map(write, range(num_archives)))
+    write_json(os.path.join(archive_dir, ARCHIVE_INDEX), {'archives': archives})
+
+
+def is_in_place(imagenet_dir, dst_dir):
+    """Whether `dst_dir` is `imagenet_dir` itself, e.g. with --scratch_path /."""
+    return os.path.realpath(dst_dir) == os.path.realpath(imagenet_dir)
+
+
+def copy_if_changed(src, dst):
+    """Copies `src` to `dst` unless `dst` already has the same size. Copies go through a temporary
+    file, so an interrupted copy is never mistaken for a complete one."""
+    if os.path.isfile(dst) and os.path.getsize(dst) == os.path.getsize(src):
+        return False
+    shutil.copy(src, dst + '.tmp')
+    os.replace(dst + '.tmp', dst)
+    return True
+
+
+def stage_imagenet(imagenet_dir, dst_dir, classes, index, archive_dir=None, num_workers=16):
+    """Copies the JPEGs of `classes` to `dst_dir`, then writes a completion marker.
+
+    If `archive_dir` holds archives written by `write_imagenet_archives`, the ones containing
+    `classes` are extracted in parallel. Otherwise the files are copied with a thread pool,
+    skipping those that a previous run already copied. Nothing is written if `dst_dir` is
+    `imagenet_dir`.
+    """
+    if is_in_place(imagenet_dir, dst_dir):
+        return
+
+    marker = os.path.join(dst_dir, f'{STAGING_COMPLETE}_{len(classes)}')
+    if os.path.exists(marker):
+        os.remove(marker)
+    os.makedirs(dst_dir, exist_ok=True)
+
+    if archive_dir is not None and os.path.isfile(os.path.join(archive_dir, ARCHIVE_INDEX)):
+        with open(os.path.join(archive_dir, ARCHIVE_INDEX)) as f:
+            archives = json.load(f)['archives']
+        wanted = set(classes)
+        paths = [os.path.join(archive_dir, a['file']) for a in archives if wanted.intersection(a['classes'])]
+
+        def extract(path):
+            with tarfile.open(path) as tar:
+                tar.extractall(dst_dir)
+
+        print(f"Extracting {len(paths)} archives to scratch...")
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            list(pool.map(extract, paths))
+    else:
+        files = [os.path.join(split, label, f) for split in ('train', 'test') for label in classes
+                 for f in index[split][label]]
+        for split in ('train', 'test'):
+            for label in classes:
+                os.makedirs(os.path.join(dst_dir, split, label), exist_ok=True)
+
+        print(f"Copying {len(files)} files to scratch...")
+        with ThreadPoolExecutor(max_workers=num_workers) as pool:
+            num_copied = sum(pool.map(lambda f: copy_if_changed(os.path.join(imagenet_dir, f),
+                                                                os.path.join(dst_dir, f)), files))
+        print(f"Copied {num_copied} files, {len(files) - num_copied} were already staged")
+
+    with open(marker, 'w') as f:
+        f.write(str(time.time()))
+    print("All Files Copied")
+
+
+def wait_for_stage(dst_dir, num_classes, imagenet_dir=None, max_interval=5):
+    """Blocks until `stage_imagenet` has written its completion marker. Every poll is a single
+    stat call. Returns at once if `dst_dir` is `imagenet_dir`."""
+    if imagenet_dir is not None and is_in_place(imagenet_dir, dst_dir):
+        return
+    interval = .1
+    while not os.path.exists(os.path.join(dst_dir, f'{STAGING_COMPLETE}_{num_classes}')):
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+
+
 class ImageNetDataset:
-    def __init__(self, imagenet_dir, scratch_dir, copy_files, is_correct_phase, num_classes=1):
+    def __init__(self, imagenet_dir, scratch_dir, copy_files, is_correct_phase, num_classes=1, archive_dir=None):
         super(ImageNetDataset, self).__init__()
 
-        train_folder = os.path.join(imagenet_dir, 'train')
-        test_folder = os.path.join(imagenet_dir, 'test')
+        stage_dir = os.path.normpath(os.path.join(scratch_dir, os.path.abspath(imagenet_dir).lstrip('/')))
+        # Only the staging process lists the folders; the others wait for its index.
+        index = imagenet_file_index(imagenet_dir, fallback_dir=stage_dir, build=copy_files)
 
-        classes_train = set(d for d in os.listdir(train_folder) if os.path.isdir(os.path.join(train_folder, d)))
-        classes_test = set(d for d in os.listdir(test_folder) if os.path.isdir(os.path.join(test_folder, d)))
-        classes_train = classes_test = classes_train.intersection(classes_test)
-
-        classes_train = sorted(list(classes_train))[:num_classes]
-        classes_test = sorted(list(classes_test))[:num_classes]
+        classes_train = classes_test = index['classes'][:num_classes]
 
         assert len(classes_train) == len(classes_test) == num_classes
 
         self.label_to_ix = {label: i for i, label in enumerate(classes_train)}
         self.ix_to_label = {i: label for label, i in self.label_to_ix.items()}
 
+        root = stage_dir if is_correct_phase else imagenet_dir
+
         train_examples = []
+        self.scratch_files_train = []
         self.train_labels = []
 
         for label in classes_train:
-            for f in glob.glob(os.path.join(train_folder, label) + '/*.JPEG'):
+            for f in index['train'][label]:
                 self.train_labels.append(self.label_to_ix[label])
-                train_examples.append(f)
+                train_examples.append(os.path.join(imagenet_dir, 'train', label, f))
+                self.scratch_files_train.append(os.path.join(root, 'train', label, f))
 
-        test_examples = []
+        self.scratch_files_test = []
         self.test_labels = []
 
         for label in classes_test:
-            for f in glob.glob(os.path.join(test_folder, label) + '/*.JPEG'):
+            for f in index['test'][label]:
                 self.test_labels.append(self.label_to_ix[label])
-                test_examples.append(f)
-
-        scratch_dir = os.path.normpath(scratch_dir) if is_correct_phase else imagenet_dir
-
-        self.scratch_files_train = [] if is_correct_phase else train_examples
-        self.scratch_files_test = [] if is_correct_phase else test_examples
+                self.scratch_files_test.append(os.path.join(root, 'test', label, f))
 
         if is_correct_phase:
-            print("Copying train files to scratch...")
-            for f in sorted(train_examples):
-                if copy_files:
-                    directory = os.path.normpath(scratch_dir + f.rsplit('/', maxsplit=1)[0])
-                    if not os.path.exists(directory):
-                        os.makedirs(directory)
-                    shutil.copy(f, os.path.normpath(scratch_dir + f))
-                self.scratch_files_train.append(os.path.normpath(scratch_dir + f))
+            if archive_dir is None:
+                archive_dir = os.path.join(imagenet_dir, 'archives')
             if copy_files:
-                print("All Files Copied")
-
-            print("Copying test files to scratch...")
-            for f in sorted(test_examples):
-                if copy_files:
-                    directory = os.path.normpath(scratch_dir + f.rsplit('/', maxsplit=1)[0])
-                    if not os.path.exists(directory):
-                        os.makedirs(directory)
-                    shutil.copy(f, os.path.normpath(scratch_dir + f))
-                self.scratch_files_test.append(os.path.normpath(scratch_dir + f))
-
-        while not all(os.path.exists(f) for f in self.scratch_files_train):
-            print(f"Waiting... {sum(os.path.exists(f) for f in self.scratch_files_train)} / {len(self.scratch_files_train)}")
-            time.sleep(1)
-
-        while not all(os.path.exists(f) for f in self.scratch_files_test):
-            print(f"Waiting... {sum(os.path.exists(f) for f in self.scratch_files_test)} / {len(self.scratch_files_test)}")
-            time.sleep(1)
-
-        if is_correct_phase:
-            assert all(os.path.isfile(f) for f in self.scratch_files_train)
-            assert all(os.path.isfile(f) for f in self.scratch_files_test)
+                stage_imagenet(imagenet_dir, stage_dir, classes_train, index, archive_dir=archive_dir)
+            wait_for_stage(stage_dir, num_classes, imagenet_dir=imagenet_dir)
 
             print(f"Length of train dataset: {len(self.scratch_files_train)}")
             print(f"Length of test dataset: {len(self.scratch_files_test)}")
 
-            assert len(self.scratch_files_train) == len(self.train_labels)
-            assert len(self.scratch_files_test) == len(self.test_labels)
-
         test_image = io.imread(train_examples[0])
         self.shape = test_image.shape
         self.dtype = test_image.dtype
@@ -118,21 +254,50 @@ class ImageNetDataset:
             return len(self.test_labels)
 
 
-def imagenet_dataset(imagenet_path, scrath_dir, size, copy_files, is_correct_phase, gpu=False, num_labels=999):
+def decode_jpeg_at_scale(contents, size):
+    """Decodes a JPEG at the smallest of 1/8, 1/4 or 1/2 scale that keeps the shortest side at
+    least `size` pixels. The downscaling happens in the DCT domain, so small target sizes cost a
+    fraction of a full decode."""
+    shape = tf.image.extract_jpeg_shape(contents)
+    min_side = tf.minimum(shape[0], shape[1])
+    branches = [(min_side >= size * ratio,
+                 lambda ratio=ratio: tf.image.decode_jpeg(contents, channels=3, ratio=ratio))
+                for ratio in (8, 4, 2)]
+    return tf.case(branches, default=lambda: tf.image.decode_jpeg(contents, channels=3), exclusive=False)
+
+
+def shuffled_indices(num_examples, rank=0, num_replicas=1, seed=0):
+    """Yields the indices of this rank's shard of a new random permutation every epoch.
+
+    All ranks draw the same permutation and take every `num_replicas`-th index of it, so the
+    shards are disjoint and equally long, and only integers are shuffled.
+    """
+    shard_size = num_examples // num_replicas
+    epoch = 0
+    while True:
+        permutation = np.random.RandomState(seed + epoch).permutation(num_examples)
+        yield from permutation[rank: shard_size * num_replicas: num_replicas]
+        epoch += 1
+
+
+def imagenet_dataset(imagenet_path, scrath_dir, size, copy_files, is_correct_phase, gpu=False, num_labels=999,
+                     rank=0, num_replicas=1, seed=0):
     imagenet_data = ImageNetDataset(imagenet_path, scratch_dir=scrath_dir, copy_files=copy_files, is_correct_phase=is_correct_phase, num_classes=num_labels)
 
-    dataset = tf.data.Dataset.from_tensor_slices((imagenet_data.scratch_files_train, imagenet_data.train_labels))
+    paths = tf.constant(imagenet_data.scratch_files_train)
+    labels = tf.constant(imagenet_data.train_labels)
+    dataset = tf.data.Dataset.from_generator(
+        lambda: shuffled_indices(len(imagenet_data), rank=rank, num_replicas=num_replicas, seed=seed), tf.int64)
+    dataset = dataset.map(lambda i: (tf.gather(paths, i), tf.gather(labels, i)))
 
     def load(path, label):
         # x = np.transpose(transform.resize((io.imread(path.decode()).astype(np.float32) - 127.5) / 127.5, (size, size)), [2, 0, 1])
         y = label
         x = tf.io.read_file(path)
-        x = (tf.image.resize(tf.image.decode_jpeg(x, channels=3), [size, size]) - 127.5) / 127.5
+        x = (tf.image.resize(decode_jpeg_at_scale(x, size), [size, size]) - 127.5) / 127.5
         x = tf.transpose(x, perm=[2, 0, 1])
         return x, y
 
-    dataset = dataset.shuffle(len(imagenet_data))
-
     if gpu:
         parallel_calls = AUTOTUNE
     else:
@@ -144,6 +309,52 @@ def imagenet_dataset(imagenet_path, scrath_dir, size, copy_files, is_correct_pha
     return dataset
 
 
+def imagenet_shards_dataset(shards_path, size, gpu=False, num_labels=999, shuffle_buffer=2 ** 14,
+                            rank=0, num_replicas=1, seed=0):
+    """Reads the {size}x{size} shards written by create_imagenet_shards.py, so that every example
+    costs size * size * 3 bytes instead of a full-size JPEG decode and resize."""
+    shards_dir = os.path.join(shards_path, f'{size}x{size}')
+    with open(os.path.join(shards_dir, SHARD_INDEX)) as f:
+        index = json.load(f)
+
+    assert index['num_classes'] >= num_labels, \
+        f"Shards contain {index['num_classes']} classes, run create_imagenet_shards.py with --num_classes {num_labels}"
+    files = [os.path.join(shards_dir, shard['file']) for shard in index['shards']]
+
+    if gpu:
+        parallel_calls = AUTOTUNE
+    else:
+        parallel_calls = int(os.environ['OMP_NUM_THREADS'])
+
+    def parse(record):
+        features = tf.io.parse_single_example(record, {
+            'image': tf.io.FixedLenFeature([], tf.string),
+            'label': tf.io.FixedLenFeature([], tf.int64),
+        })
+        x = tf.reshape(tf.io.decode_raw(features['image'], tf.uint8), [size, size, 3])
+        x = (tf.cast(x, tf.float32) - 127.5) / 127.5
+        x = tf.transpose(x, perm=[2, 0, 1])
+        y = tf.cast(features['label'], tf.int32)
+        return x, y
+
+    dataset = tf.data.Dataset.from_tensor_slices(files)
+    if len(files) >= num_replicas:
+        # Every rank reads only its own files.
+        dataset = dataset.shard(num_replicas, rank)
+    # All ranks must shuffle the files in the same order, or record-level sharding below is not disjoint.
+    dataset = dataset.shuffle(len(files), seed=seed)
+    dataset = dataset.interleave(tf.data.TFRecordDataset, cycle_length=min(len(files), 16),
+                                 num_parallel_calls=parallel_calls)
+    if len(files) < num_replicas:
+        dataset = dataset.shard(num_replicas, rank)
+    dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+    dataset = dataset.map(parse, num_parallel_calls=parallel_calls)
+    if index['num_classes'] > num_labels:
+        # The classes are sorted, so the first `num_labels` are the ones ImageNetDataset would use.
+        dataset = dataset.filter(lambda x, y: y < num_labels)
+    return dataset
+
+
 class NumpyPathDataset:
     def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase):
         super(NumpyPathDataset, self).__init__()
@@ -7,7 +7,7 @@ import time
 import random
 from metrics import (calculate_fid_given_batch_volumes, get_swd_for_volumes,
                      get_normalized_root_mse, get_mean_squared_error, get_psnr, get_ssim)
-from dataset import imagenet_dataset
+from dataset import imagenet_dataset, imagenet_shards_dataset
 from utils import count_parameters, image_grid, parse_tuple
 # from mpi4py import MPI
 import os
@@ -71,7 +71,18 @@ def main(args, config):
                                        copy_files=local_rank == 0,
                                        is_correct_phase=phase >= args.starting_phase,
                                        gpu=args.gpu,
-                                       num_labels=1 if args.num_labels is None else args.num_labels)
+                                       num_labels=1 if args.num_labels is None else args.num_labels,
+                                       rank=hvd.rank() if args.horovod else 0,
+                                       num_replicas=global_size,
+                                       seed=args.seed)
+        elif args.dataset == 'imagenet_shards':
+            dataset = imagenet_shards_dataset(args.dataset_path,
+                                              size,
+                                              gpu=args.gpu,
+                                              num_labels=1 if args.num_labels is None else args.num_labels,
+                                              rank=hvd.rank() if args.horovod else 0,
+                                              num_replicas=global_size,
+                                              seed=args.seed)
         else:
             raise ValueError(f"Unknown dataset {args.dataset_path}")
 
@@ -83,9 +94,6 @@ def main(args, config):
             if verbose:
                 print(f"Using local batch size of {batch_size} and global batch size of {batch_size * global_size}")
 
-        if args.horovod:
-            dataset.shard(hvd.size(), hvd.rank())
-
         dataset = dataset.batch(batch_size, drop_remainder=True)
         dataset = dataset.repeat()
         dataset = dataset.prefetch(AUTOTUNE)
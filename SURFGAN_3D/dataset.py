@@ -7,6 +7,17 @@ import tensorflow as tf
 import multiprocessing
 import itertools
 import psutil
+import queue
+import threading
+import collections
+import hashlib
+from concurrent.futures import ThreadPoolExecutor
+from multiprocessing import shared_memory, resource_tracker
+from storage import (PackedVolumes, ChunkedVolumes, Hdf5Volumes, read_json, hdf5_path, PACKED_DATA, PACKED_INDEX,
+                     CHUNKED_DATA, CHUNKED_INDEX, TFRECORD_INDEX)
+from staging import stage_files, wait_for_stage, is_in_place
+from pyramid import downsample_volume
+from utils import sample_box
 
 class NumpyDataset:
     def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase):
@@ -50,9 +61,17 @@ class NumpyDataset:
 
 
 class NumpyPathDataset:
-    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase):
+    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase, index=None, verify_staging=True):
         super(NumpyPathDataset, self).__init__()
-        self.npy_files = glob.glob(npy_dir + '*.npy')
+        # With an index (see storage.update_index), no filesystem calls are needed to list the
+        # files or to learn their shape.
+        self.index = index
+        if index is None:
+            self.npy_files = self.source_files(npy_dir)
+            stats = None
+        else:
+            self.npy_files = [os.path.join(npy_dir, e['name']) for e in index['files']]
+            stats = {e['name']: (e['size'], e['mtime']) for e in index['files']}
         print(f"Length of dataset: {len(self.npy_files)}")
 
         if scratch_dir is not None:
@@ -60,24 +79,28 @@ class NumpyPathDataset:
                 scratch_dir = scratch_dir[:-1]
 
         self.scratch_dir = os.path.normpath(scratch_dir + npy_dir) if is_correct_phase else npy_dir
-        if copy_files and is_correct_phase:
-            os.makedirs(self.scratch_dir, exist_ok=True)
-            print("Copying files to scratch...")
-            for f in self.npy_files:
-                # os.path.isdir(self.scratch_dir)
-                if not os.path.isfile(os.path.normpath(scratch_dir + f)):
-                    shutil.copy(f, os.path.normpath(scratch_dir + f))
+        names = [os.path.basename(f) for f in self.npy_files]
+        if is_correct_phase:
+            if copy_files:
+                print("Copying files to scratch...")
+                stage_files(self.npy_files, self.scratch_dir, src_dir=npy_dir, stats=stats, verify=verify_staging)
+            wait_for_stage(self.scratch_dir, names, src_dir=npy_dir)
 
-        while len(glob.glob(self.scratch_dir + '/*.npy')) < len(self.npy_files):
-            time.sleep(1)
+        self.scratch_files = [os.path.join(self.scratch_dir, name) for name in names]
 
-        self.scratch_files = glob.glob(self.scratch_dir + '/*.npy')
-        assert len(self.scratch_files) == len(self.npy_files)
+        if index is None:
+            test_npy_array = np.load(self.scratch_files[0])[np.newaxis, ...]
+            self.shape = test_npy_array.shape
+            self.dtype = test_npy_array.dtype
+            del test_npy_array
+        else:
+            self.shape = (1, *index['files'][0]['shape'])
+            self.dtype = np.dtype(index['files'][0]['dtype'])
 
-        test_npy_array = np.load(self.scratch_files[0])[np.newaxis, ...]
-        self.shape = test_npy_array.shape
-        self.dtype = test_npy_array.dtype
-        del test_npy_array
+    @staticmethod
+    def source_files(npy_dir):
+        """The files that are staged to scratch for `npy_dir`."""
+        return sorted(glob.glob(npy_dir + '*.npy'))
 
     def __iter__(self):
         for path in self.scratch_files:
@@ -89,3 +112,614 @@ class NumpyPathDataset:
     def __len__(self):
         return len(self.scratch_files)
 
+    def load(self, idx):
+        return np.load(self.scratch_files[idx])
+
+    def load_box(self, idx, slices):
+        return np.array(np.load(self.scratch_files[idx], mmap_mode='r')[slices])
+
+
+class PackedDataset:
+    """Drop-in replacement for NumpyPathDataset that reads a phase written by
+    `storage.write_packed`, i.e. one memory-mapped file instead of one file per volume."""
+    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase, verify_staging=True):
+        super(PackedDataset, self).__init__()
+
+        if scratch_dir is not None:
+            if scratch_dir[-1] == '/':
+                scratch_dir = scratch_dir[:-1]
+
+        self.scratch_dir = os.path.normpath(scratch_dir + npy_dir) if is_correct_phase else npy_dir
+        if is_correct_phase:
+            if copy_files:
+                print("Copying packed data to scratch...")
+                stage_files(self.source_files(npy_dir), self.scratch_dir, src_dir=npy_dir, verify=verify_staging)
+            wait_for_stage(self.scratch_dir, (PACKED_DATA, PACKED_INDEX), src_dir=npy_dir)
+
+        self.volumes = PackedVolumes(self.scratch_dir)
+        self.data_file = os.path.join(self.scratch_dir, PACKED_DATA)
+        print(f"Length of dataset: {len(self.volumes)}")
+
+        self.shape = (1, *self.volumes.shapes[0])
+        self.dtype = self.volumes.dtype
+
+    @staticmethod
+    def source_files(npy_dir):
+        return [os.path.join(npy_dir, f) for f in (PACKED_DATA, PACKED_INDEX)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.volumes[i]
+
+    def __getitem__(self, idx):
+        return self.volumes[idx]
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def load(self, idx):
+        return self.volumes[idx]
+
+    def load_batch(self, indices):
+        return self.volumes.take(indices)
+
+    def load_box(self, idx, slices):
+        return self.volumes.read_box(idx, slices)
+
+
+class ChunkedDataset:
+    """Drop-in replacement for NumpyPathDataset that reads a phase written by
+    `storage.ChunkedWriter`, i.e. compressed chunks that are decompressed in parallel."""
+    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase, num_workers=None, verify_staging=True):
+        super(ChunkedDataset, self).__init__()
+
+        if scratch_dir is not None:
+            if scratch_dir[-1] == '/':
+                scratch_dir = scratch_dir[:-1]
+
+        self.scratch_dir = os.path.normpath(scratch_dir + npy_dir) if is_correct_phase else npy_dir
+        if is_correct_phase:
+            if copy_files:
+                print("Copying chunked data to scratch...")
+                stage_files(self.source_files(npy_dir), self.scratch_dir, src_dir=npy_dir, verify=verify_staging)
+            wait_for_stage(self.scratch_dir, (CHUNKED_DATA, CHUNKED_INDEX), src_dir=npy_dir)
+
+        self.volumes = ChunkedVolumes(self.scratch_dir, num_workers=num_workers)
+        self.data_file = os.path.join(self.scratch_dir, CHUNKED_DATA)
+        print(f"Length of dataset: {len(self.volumes)}")
+
+        self.shape = (1, *self.volumes.shape)
+        self.dtype = self.volumes.dtype
+
+    @staticmethod
+    def source_files(npy_dir):
+        return [os.path.join(npy_dir, f) for f in (CHUNKED_DATA, CHUNKED_INDEX)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.volumes[i]
+
+    def __getitem__(self, idx):
+        return self.volumes[idx]
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def load(self, idx):
+        return self.volumes[idx]
+
+    def load_batch(self, indices):
+        return self.volumes.take(indices)
+
+    def read_into(self, idx, out):
+        return self.volumes.read_into(idx, out)
+
+    def load_box(self, idx, slices):
+        return self.volumes.read_box(idx, slices)
+
+    def close(self):
+        self.volumes.close()
+
+
+class Hdf5Dataset:
+    """Drop-in replacement for NumpyPathDataset that reads a phase from the single {size}x{size}.h5
+    file written by `storage.Hdf5Writer`. `BatchLoader` fetches every batch with one read through
+    `load_batch`."""
+    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase, verify_staging=True):
+        super(Hdf5Dataset, self).__init__()
+
+        if scratch_dir is not None:
+            if scratch_dir[-1] == '/':
+                scratch_dir = scratch_dir[:-1]
+
+        self.scratch_dir = os.path.normpath(scratch_dir + npy_dir) if is_correct_phase else npy_dir
+        name = os.path.basename(hdf5_path(npy_dir))
+        if is_correct_phase and not is_in_place(npy_dir, self.scratch_dir):
+            if copy_files:
+                print("Copying HDF5 file to scratch...")
+                stage_files(self.source_files(npy_dir), self.scratch_dir, verify=verify_staging)
+            wait_for_stage(self.scratch_dir, (name,))
+            path = os.path.join(self.scratch_dir, name)
+        else:
+            path = hdf5_path(npy_dir)
+
+        self.volumes = Hdf5Volumes(path)
+        self.data_file = path
+        print(f"Length of dataset: {len(self.volumes)}")
+
+        self.shape = (1, *self.volumes.shape)
+        self.dtype = self.volumes.dtype
+
+    @staticmethod
+    def source_files(npy_dir):
+        return [hdf5_path(npy_dir)]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.volumes[i]
+
+    def __getitem__(self, idx):
+        return self.volumes[idx]
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def load(self, idx):
+        return self.volumes[idx]
+
+    def load_batch(self, indices):
+        return self.volumes.take(indices)
+
+    def load_box(self, idx, slices):
+        return self.volumes.read_box(idx, slices)
+
+    def close(self):
+        self.volumes.close()
+
+
+class TFRecordDataset:
+    """Reads a phase written by data_scripts/process_lidc_idri_data.py: a few large, optionally
+    compressed TFRecord shards of raw volume bytes plus an index. Only usable with
+    --input_pipeline tf_data, see `tf_dataset`."""
+    def __init__(self, npy_dir, scratch_dir, copy_files, is_correct_phase, verify_staging=True):
+        super(TFRecordDataset, self).__init__()
+
+        if scratch_dir is not None:
+            if scratch_dir[-1] == '/':
+                scratch_dir = scratch_dir[:-1]
+
+        self.scratch_dir = os.path.normpath(scratch_dir + npy_dir) if is_correct_phase else npy_dir
+        index = read_json(os.path.join(npy_dir, TFRECORD_INDEX))
+        names = [TFRECORD_INDEX] + [shard['file'] for shard in index['shards']]
+        if is_correct_phase:
+            if copy_files:
+                print("Copying TFRecord shards to scratch...")
+                stage_files([os.path.join(npy_dir, name) for name in names], self.scratch_dir,
+                            src_dir=npy_dir, verify=verify_staging)
+            wait_for_stage(self.scratch_dir, names, src_dir=npy_dir)
+
+        self.files = [os.path.join(self.scratch_dir, shard['file']) for shard in index['shards']]
+        self.num_examples = sum(shard['num_examples'] for shard in index['shards'])
+        self.compression = index['compression']
+        print(f"Length of dataset: {self.num_examples}")
+
+        self.shape = (1, *index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+
+    @staticmethod
+    def source_files(npy_dir):
+        index = read_json(os.path.join(npy_dir, TFRECORD_INDEX))
+        return [os.path.join(npy_dir, f) for f in [TFRECORD_INDEX] + [shard['file'] for shard in index['shards']]]
+
+    def __len__(self):
+        return self.num_examples
+
+    def parse(self, record):
+        features = tf.io.parse_single_example(record, {'image': tf.io.FixedLenFeature([], tf.string)})
+        x = tf.io.decode_raw(features['image'], tf.as_dtype(self.dtype))
+        return tf.reshape(x, self.shape)
+
+    def tf_dataset(self, rank=0, num_replicas=1, seed=0, shuffle_buffer=64, parallel_calls=None):
+        """An endless, shuffled dataset of (1, D, H, W) volumes in their stored dtype.
+
+        With enough shards every rank reads only its own files, otherwise records are sharded.
+        """
+        dataset = tf.data.Dataset.from_tensor_slices(self.files)
+        shard_files = len(self.files) >= num_replicas
+        if shard_files:
+            dataset = dataset.shard(num_replicas, rank)
+        dataset = dataset.shuffle(len(self.files), seed=seed).repeat()
+        dataset = dataset.interleave(lambda f: tf.data.TFRecordDataset(f, compression_type=self.compression),
+                                     cycle_length=min(len(self.files), 4), num_parallel_calls=parallel_calls)
+        if not shard_files:
+            dataset = dataset.shard(num_replicas, rank)
+        dataset = dataset.shuffle(shuffle_buffer, seed=seed)
+        return dataset.map(self.parse, num_parallel_calls=parallel_calls)
+
+
+def stored_levels(dataset_path):
+    """Returns the sizes of the {size}x{size}/ directories or {size}x{size}.h5 files in `dataset_path`,
+    ascending."""
+    sizes = []
+    for d in os.listdir(dataset_path):
+        is_hdf5 = d.endswith('.h5')
+        height, _, width = (d[:-len('.h5')] if is_hdf5 else d).partition('x')
+        if height.isdigit() and height == width and (is_hdf5 or os.path.isdir(os.path.join(dataset_path, d))):
+            sizes.append(int(height))
+    return sorted(sizes)
+
+
+class PyramidDataset:
+    """Serves a coarser resolution level computed on the fly from a finer stored level.
+
+    Volumes are reduced by `factor` along every axis on first access and kept in an LRU cache of
+    at most `cache_bytes` in RAM. If `cache_dir` is given, reduced volumes are also written
+    there, so other processes and later runs can reuse them. Cached files are named after the
+    source volume and the mtime of the file it is read from, so a changed source set is never
+    served from the cache.
+    """
+    def __init__(self, dataset, factor, reduce='average', cache_bytes=2 ** 33, cache_dir=None):
+        super(PyramidDataset, self).__init__()
+        self.dataset = dataset
+        self.factor = factor
+        self.reduce = reduce
+        self.cache_bytes = cache_bytes
+        self.cache_dir = cache_dir
+        self.scratch_dir = cache_dir if cache_dir is not None else dataset.scratch_dir
+
+        self.shape = (1, *[s // factor for s in dataset.shape[1:]])
+        self.dtype = np.dtype(dataset.dtype)
+        self.volume_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+
+        self.cache = collections.OrderedDict()
+        self.lock = threading.Lock()
+
+        if cache_dir is not None:
+            os.makedirs(cache_dir, exist_ok=True)
+
+    def _cache_path(self, idx):
+        if hasattr(self.dataset, 'scratch_files'):
+            path = self.dataset.scratch_files[idx]
+            name = os.path.basename(path)
+        else:
+            path = self.dataset.data_file
+            name = self.dataset.volumes.files[idx]
+        stem = os.path.splitext(os.path.basename(name))[0]
+        return os.path.join(self.cache_dir, f'{stem}.{os.stat(path).st_mtime_ns}.npy')
+
+    def _compute(self, idx):
+        if self.cache_dir is not None:
+            cache_path = self._cache_path(idx)
+            if os.path.isfile(cache_path):
+                return np.load(cache_path)
+
+        volume = downsample_volume(self.dataset.load(idx), self.factor, reduce=self.reduce)
+        if self.cache_dir is not None:
+            # Other threads and local ranks may compute the same volume at the same time.
+            tmp_path = f'{cache_path}.{os.getpid()}.{threading.get_ident()}.tmp.npy'
+            np.save(tmp_path, volume)
+            os.replace(tmp_path, cache_path)
+        return volume
+
+    def load(self, idx):
+        with self.lock:
+            if idx in self.cache:
+                self.cache.move_to_end(idx)
+                return self.cache[idx]
+
+        volume = self._compute(idx)
+
+        with self.lock:
+            self.cache[idx] = volume
+            while len(self.cache) * self.volume_bytes > self.cache_bytes and len(self.cache) > 1:
+                self.cache.popitem(last=False)
+        return volume
+
+    def load_box(self, idx, slices):
+        return self.load(idx)[slices]
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.load(i)
+
+    def __getitem__(self, idx):
+        return self.load(idx)
+
+    def __len__(self):
+        return len(self.dataset)
+
+    def close(self):
+        self.cache.clear()
+        if hasattr(self.dataset, 'close'):
+            self.dataset.close()
+
+
+class SharedMemoryDataset:
+    """Keeps a whole phase of `dataset` in POSIX shared memory.
+
+    The process that passes `create=True` (local rank 0) loads every volume once and the other
+    processes on the node attach to the same segment read-only, so batches are plain in-memory
+    indexing without any file I/O. Meant for the low resolution phases that fit in RAM.
+
+    All processes must pass the same `token`, unique to the run, e.g. drawn by rank 0 and
+    broadcast. It is part of the segment name, so nobody attaches to a segment left behind by an
+    earlier run, whose ready flag is already set.
+    """
+    header_size = 64
+
+    def __init__(self, dataset, create, token, num_workers=None):
+        super(SharedMemoryDataset, self).__init__()
+        if num_workers is None:
+            num_workers = int(os.environ.get('OMP_NUM_THREADS', 1))
+
+        self.dataset = dataset
+        self.shape = dataset.shape
+        self.dtype = dataset.dtype
+        self.create = create
+        self.length = len(dataset)
+
+        array_shape = (self.length, *self.shape[1:])
+        nbytes = self.header_size + int(np.prod(array_shape)) * np.dtype(self.dtype).itemsize
+
+        # Every rank on the node derives the same name from the run, the phase directory and the
+        # volume shape, since pyramid phases can all be read from the same directory.
+        key = f'{token}{os.path.abspath(dataset.scratch_dir)}{array_shape}{np.dtype(self.dtype).str}'
+        self.name = 'surfgan_' + hashlib.md5(key.encode()).hexdigest()[:16]
+
+        if create:
+            try:
+                stale = shared_memory.SharedMemory(name=self.name)
+                stale.close()
+                stale.unlink()
+            except FileNotFoundError:
+                pass
+            self.shm = shared_memory.SharedMemory(name=self.name, create=True, size=nbytes)
+        else:
+            while True:
+                try:
+                    self.shm = shared_memory.SharedMemory(name=self.name)
+                    break
+                except FileNotFoundError:
+                    time.sleep(.1)
+            # Only the creating process may unlink the segment, see https://bugs.python.org/issue39959
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+
+        self.ready = np.ndarray((1,), dtype=np.uint8, buffer=self.shm.buf)
+        self.array = np.ndarray(array_shape, dtype=self.dtype, buffer=self.shm.buf, offset=self.header_size)
+
+        if create:
+            print("Loading dataset into shared memory...")
+            with ThreadPoolExecutor(max_workers=num_workers) as pool:
+                list(pool.map(lambda i: self.array.__setitem__(i, dataset.load(i)), range(self.length)))
+            self.ready[0] = 1
+        else:
+            while self.ready[0] != 1:
+                time.sleep(.1)
+            self.array.flags.writeable = False
+
+    def __iter__(self):
+        for i in range(len(self)):
+            yield self.array[i]
+
+    def __getitem__(self, idx):
+        return self.array[idx]
+
+    def __len__(self):
+        return self.length
+
+    def load(self, idx):
+        return self.array[idx]
+
+    def load_batch(self, indices):
+        return self.array[np.asarray(indices)]
+
+    def load_box(self, idx, slices):
+        return self.array[idx][slices]
+
+    def close(self):
+        del self.ready, self.array
+        self.shm.close()
+        if self.create:
+            self.shm.unlink()
+        if hasattr(self.dataset, 'close'):
+            self.dataset.close()
+
+
+def read_npy_header(path):
+    """Returns the shape, dtype and header size in bytes of a .npy file."""
+    with open(path, 'rb') as f:
+        version = np.lib.format.read_magic(f)
+        if version == (1, 0):
+            shape, fortran_order, dtype = np.lib.format.read_array_header_1_0(f)
+        else:
+            shape, fortran_order, dtype = np.lib.format.read_array_header_2_0(f)
+        header_size = f.tell()
+
+    if fortran_order:
+        raise ValueError(f"{path}: Fortran ordered arrays are not supported (dtype {dtype}).")
+    return shape, dtype, header_size
+
+
+def npy_decoder(example_path):
+    """Returns a function that loads a .npy file in-graph with `tf.io.read_file` and
+    `tf.io.decode_raw`.
+
+    The header of `example_path` is parsed once; all files passed to the decoder must share its
+    shape and dtype. Unlike `tf.py_function(np.load)` this does not hold the GIL, so it scales
+    with `num_parallel_calls`.
+    """
+    shape, dtype, header_size = read_npy_header(example_path)
+    if dtype.byteorder == '>' or dtype.kind not in 'biuf':
+        raise ValueError(f"{example_path}: unsupported dtype {dtype.str}, expected a little-endian "
+                         f"bool, integer or float array.")
+    payload_size = int(np.prod(shape)) * dtype.itemsize
+
+    def decode(path):
+        raw = tf.strings.substr(tf.io.read_file(path), header_size, payload_size)
+        x = tf.io.decode_raw(raw, tf.as_dtype(dtype))
+        return tf.reshape(x, (1, *shape))
+
+    return decode
+
+
+def normalize(x, intercept, scale):
+    """Casts raw volumes to float32 and maps them to the training range in-graph."""
+    return (tf.cast(x, tf.float32) - intercept) / scale
+
+
+DATASET_FORMATS = {
+    'npy': NumpyPathDataset,
+    'packed': PackedDataset,
+    'chunked': ChunkedDataset,
+    'tfrecord': TFRecordDataset,
+    'hdf5': Hdf5Dataset,
+}
+
+
+class DistributedSampler:
+    """Yields batches of dataset indices, epoch after epoch.
+
+    The indices are split into `num_replicas` disjoint shards with a permutation that only
+    depends on `seed`, so all ranks agree on the split without communicating. Every epoch, a
+    rank visits each index of its own shard once in a new order. With `fixed_shards=False` the
+    split itself is redrawn every epoch, which mixes the data better across ranks but gives up
+    page-cache locality.
+    """
+    def __init__(self, num_samples, batch_size, rank=0, num_replicas=1, seed=0, fixed_shards=True):
+        super(DistributedSampler, self).__init__()
+        self.num_samples = num_samples
+        self.batch_size = batch_size
+        self.rank = rank
+        self.num_replicas = num_replicas
+        self.seed = seed
+        self.fixed_shards = fixed_shards
+        self.shard_size = num_samples // num_replicas
+        self.epoch = 0
+
+        if self.shard_size < batch_size:
+            raise ValueError(f"Shard of {self.shard_size} samples is smaller than the batch size {batch_size}")
+
+    def shard(self, epoch):
+        split_seed = self.seed if self.fixed_shards else self.seed + epoch
+        permutation = np.random.RandomState(split_seed).permutation(self.num_samples)
+        shard = permutation[self.rank: self.shard_size * self.num_replicas: self.num_replicas]
+        return np.random.RandomState(self.seed + epoch + 1).permutation(shard)
+
+    def __len__(self):
+        return self.shard_size // self.batch_size
+
+    def __iter__(self):
+        while True:
+            shard = self.shard(self.epoch)
+            for i in range(len(self)):
+                yield shard[i * self.batch_size: (i + 1) * self.batch_size]
+            self.epoch += 1
+
+
+class BatchLoader:
+    """Reads batches in a background thread pool.
+
+    Batch indices come from `sampler`, or are random contiguous windows if it is None. Datasets
+    with a `load_batch` method read a whole batch at once, e.g. as a single gather from a memory
+    map; others are read volume by volume. At most `prefetch` batches are being read or waiting
+    to be taken at any time: a slot is taken when a batch is submitted and freed when
+    `__next__` hands it to the trainer. Batches keep the dtype of the dataset; normalization is left to the graph
+    (see `normalize`). If `patch_shape` is given, a random box of that shape is read from every
+    volume instead of the whole volume, so I/O scales with the patch size.
+
+    The time `__next__` spends waiting for a batch is accumulated in `stall_time`; a non-zero
+    stall means the training loop waits on I/O.
+    """
+    def __init__(self, dataset, batch_size, num_workers=None, prefetch=2, sampler=None, patch_shape=None,
+                 seed=None):
+        super(BatchLoader, self).__init__()
+        if num_workers is None:
+            num_workers = int(os.environ.get('OMP_NUM_THREADS', 1))
+
+        self.dataset = dataset
+        self.batch_size = batch_size
+        self.prefetch = prefetch
+        self.batches = iter(sampler) if sampler is not None else None
+        self.patch_shape = tuple(patch_shape) if patch_shape is not None else None
+        self.random_state = np.random.RandomState(seed)
+        self.stall_time = 0
+        self.last_stall_time = 0
+
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+        self.slots = threading.Semaphore(prefetch)
+        self.queue = queue.Queue()
+        self.stop_event = threading.Event()
+        self.thread = threading.Thread(target=self._produce, daemon=True)
+        self.thread.start()
+
+    def _next_indices(self):
+        if self.batches is not None:
+            return next(self.batches)
+
+        batch_loc = np.random.randint(0, len(self.dataset) - self.batch_size)
+        return range(batch_loc, batch_loc + self.batch_size)
+
+    def _read(self, batch, i, idx, box):
+        if box is not None:
+            batch[i, 0] = self.dataset.load_box(idx, box)
+        elif hasattr(self.dataset, 'read_into'):
+            self.dataset.read_into(idx, batch[i, 0])
+        else:
+            batch[i, 0] = self.dataset.load(idx)
+
+    def _submit(self, indices):
+        """Starts reading the batch `indices` and returns a function that waits for and returns it."""
+        if self.patch_shape is None and hasattr(self.dataset, 'load_batch'):
+            # One slice or gather for the whole batch instead of one read per volume.
+            future = self.pool.submit(self.dataset.load_batch, indices)
+            return lambda: future.result()[:, np.newaxis]
+
+        if self.patch_shape is not None:
+            boxes = [sample_box(self.dataset.shape[1:], self.patch_shape, self.patch_shape, self.random_state)
+                     for _ in indices]
+            shape = (1, *self.patch_shape)
+        else:
+            boxes = [None] * len(indices)
+            shape = self.dataset.shape
+
+        batch = np.empty((self.batch_size, *shape), dtype=self.dataset.dtype)
+        futures = [self.pool.submit(self._read, batch, i, idx, box)
+                   for i, (idx, box) in enumerate(zip(indices, boxes))]
+
+        def result():
+            for future in futures:
+                future.result()
+            return batch
+        return result
+
+    def _produce(self):
+        in_flight = collections.deque()
+        try:
+            while not self.stop_event.is_set():
+                if in_flight and not self.slots.acquire(blocking=False):
+                    # No free slot: hand over the oldest batch once it is read.
+                    self.queue.put(in_flight.popleft()())
+                elif in_flight or self.slots.acquire(timeout=1):
+                    in_flight.append(self._submit(self._next_indices()))
+        except Exception as e:
+            self.queue.put(e)
+
+    def __iter__(self):
+        return self
+
+    def __next__(self):
+        start = time.perf_counter()
+        item = self.queue.get()
+        self.last_stall_time = time.perf_counter() - start
+        self.stall_time += self.last_stall_time
+
+        if isinstance(item, Exception):
+            raise item
+        self.slots.release()
+        return item
+
+    def close(self):
+        self.stop_event.set()
+        self.thread.join()
+        self.pool.shutdown()
+
@@ -6,7 +6,8 @@ import time
 import random
 from metrics import (calculate_fid_given_batch_volumes, get_swd_for_volumes,
                      get_normalized_root_mse, get_mean_squared_error, get_psnr, get_ssim)
-from dataset import NumpyPathDataset
+from dataset import DATASET_FORMATS, npy_decoder, normalize
+from storage import read_dataset_metadata
 from utils import count_parameters, image_grid, parse_tuple
 from mpi4py import MPI
 import os
@@ -53,8 +54,11 @@ def main(args, config):
     num_phases = int(np.log2(final_resolution) - 1)
     size = 2 * 2 ** phase
     data_path = os.path.join(args.dataset_path, f'{size}x{size}/')
-    npy_data = NumpyPathDataset(data_path, None,  copy_files=False, is_correct_phase=False)
-    dataset = tf.data.Dataset.from_tensor_slices(npy_data.scratch_files)
+    npy_data = DATASET_FORMATS[args.data_format](data_path, None,  copy_files=False, is_correct_phase=False)
+    if args.data_format == 'npy':
+        dataset = tf.data.Dataset.from_tensor_slices(npy_data.scratch_files)
+    else:
+        dataset = tf.data.Dataset.range(len(npy_data))
 
     batch_size = 1
 
@@ -62,13 +66,18 @@ def main(args, config):
         dataset.shard(hvd.size(), hvd.rank())
 
     def load(x):
-        x = np.load(x.numpy().decode('utf-8'))[np.newaxis, ...]
+        x = np.asarray(npy_data.load(int(x.numpy())))[np.newaxis, ...]
         return x
 
     # Lay out the graph.
     dataset = dataset.shuffle(len(npy_data))
-    dataset = dataset.map(lambda x: tf.py_function(func=load, inp=[x], Tout=tf.uint16), num_parallel_calls=AUTOTUNE)
-    dataset = dataset.map(lambda x: tf.cast(x, tf.float32) / 1024 - 1, num_parallel_calls=AUTOTUNE)
+    if args.data_format == 'npy':
+        dataset = dataset.map(npy_decoder(npy_data.scratch_files[0]), num_parallel_calls=AUTOTUNE)
+    else:
+        dataset = dataset.map(lambda x: tf.py_function(func=load, inp=[x], Tout=tf.as_dtype(npy_data.dtype)), num_parallel_calls=AUTOTUNE)
+    metadata = read_dataset_metadata(args.dataset_path)
+    dataset = dataset.map(lambda x: normalize(x, metadata['intercept'], metadata['scale']),
+                          num_parallel_calls=AUTOTUNE)
     dataset = dataset.batch(batch_size, drop_remainder=True)
     dataset = dataset.repeat()
     dataset = dataset.prefetch(AUTOTUNE)
@@ -234,6 +243,7 @@ if __name__ == '__main__':
     parser.add_argument('--leakiness', type=float, default=0.2)
     parser.add_argument('--seed', type=int, default=42)
     parser.add_argument('--horovod', default=False, action='store_true')
+    parser.add_argument('--data_format', default='npy', choices=['npy', 'packed', 'chunked', 'hdf5'])
     args = parser.parse_args()
 
     config = tf.ConfigProto()
@@ -1,13 +1,17 @@
 # pylint: disable=import-error
 import argparse
+import functools
 import numpy as np
 import tensorflow as tf
 import horovod.tensorflow as hvd
 import time
 import random
+import uuid
 from metrics import (calculate_fid_given_batch_volumes, get_swd_for_volumes,
                      get_normalized_root_mse, get_mean_squared_error, get_psnr, get_ssim)
-from dataset import NumpyPathDataset
+from dataset import DATASET_FORMATS, PyramidDataset, stored_levels, BatchLoader, DistributedSampler, SharedMemoryDataset, npy_decoder, normalize
+from storage import read_dataset_metadata, update_index
+from staging import BackgroundStager, is_in_place
 from utils import count_parameters, image_grid, parse_tuple, MPMap
 # from mpi4py import MPI
 import os
@@ -20,6 +24,36 @@ from tensorflow.data.experimental import AUTOTUNE
 import nvgpu
 
 
+def get_index(npy_dir, scratch_path, global_rank, horovod):
+    """Rank 0 brings the index of `npy_dir` up to date and broadcasts it, so that the other ranks
+    do not touch the shared filesystem to list the dataset."""
+    index = None
+    if global_rank == 0:
+        index = update_index(npy_dir, fallback_dir=os.path.normpath(scratch_path + npy_dir))
+    if horovod:
+        from mpi4py import MPI
+        index = MPI.COMM_WORLD.bcast(index, root=0)
+    return index
+
+
+def get_run_token(global_rank, horovod):
+    """A random token drawn by rank 0 and broadcast, so that it is the same on every rank but
+    differs between runs."""
+    token = uuid.uuid4().hex[:16] if global_rank == 0 else None
+    if horovod:
+        from mpi4py import MPI
+        token = MPI.COMM_WORLD.bcast(token, root=0)
+    return token
+
+
+def stored_size(args, size):
+    """The resolution that is read from disk for `size`: with --pyramid, missing levels are
+    computed from the nearest finer level that is stored."""
+    if args.pyramid and size not in stored_levels(args.dataset_path):
+        return min(s for s in stored_levels(args.dataset_path) if s > size)
+    return size
+
+
 def main(args, config):
 
     if args.horovod:
@@ -52,8 +86,14 @@ def main(args, config):
     num_phases = int(np.log2(final_resolution) - 1)
     base_dim = num_filters(-num_phases + 1, num_phases, size=args.network_size)
 
+    metadata = read_dataset_metadata(args.dataset_path)
+    if verbose:
+        print(f"Normalizing with intercept {metadata['intercept']} and scale {metadata['scale']}")
+
     var_list = list()
     global_step = 0
+    stager = None
+    run_token = get_run_token(global_rank, args.horovod) if args.shared_memory_phases > 0 else None
 
     for phase in range(1, num_phases + 1):
 
@@ -64,9 +104,51 @@ def main(args, config):
 
         size = 2 * 2 ** phase
 
+        if stager is not None:
+            stage_wait = stager.wait()
+            stager = None
+            print(f"Waited {stage_wait:.1f}s for background staging of phase {phase}")
+
         data_path = os.path.join(args.dataset_path, f'{size}x{size}/')
-        npy_data = NumpyPathDataset(data_path, args.scratch_path, copy_files=local_rank == 0,
-                                    is_correct_phase=phase >= args.starting_phase)
+        source_size = stored_size(args, size)
+        if source_size != size:
+            # Compute this level from the nearest finer level that is stored.
+            source_path = os.path.join(args.dataset_path, f'{source_size}x{source_size}/')
+            kwargs = {'verify_staging': not args.no_stage_checksums}
+            if args.data_format == 'npy' and phase >= args.starting_phase:
+                kwargs['index'] = get_index(source_path, args.scratch_path, global_rank, args.horovod)
+            npy_data = DATASET_FORMATS[args.data_format](source_path, args.scratch_path,
+                                                         copy_files=local_rank == 0,
+                                                         is_correct_phase=phase >= args.starting_phase, **kwargs)
+            cache_dir = os.path.normpath(args.scratch_path + data_path) if phase >= args.starting_phase else None
+            if cache_dir is not None and is_in_place(data_path, cache_dir):
+                # Never write a partial level into the dataset itself, e.g. with --scratch_path /.
+                cache_dir = None
+            npy_data = PyramidDataset(npy_data, source_size // size, reduce=args.pyramid_reduce,
+                                      cache_bytes=int(args.pyramid_cache_gb * 2 ** 30), cache_dir=cache_dir)
+            if verbose:
+                print(f"Computing {size}x{size} on the fly from {source_size}x{source_size}")
+        else:
+            kwargs = {'verify_staging': not args.no_stage_checksums}
+            if args.data_format == 'npy' and phase >= args.starting_phase:
+                kwargs['index'] = get_index(data_path, args.scratch_path, global_rank, args.horovod)
+            npy_data = DATASET_FORMATS[args.data_format](data_path, args.scratch_path, copy_files=local_rank == 0,
+                                                         is_correct_phase=phase >= args.starting_phase, **kwargs)
+
+        if (args.background_staging and local_rank == 0 and args.starting_phase <= phase < num_phases
+                and (not args.ending_phase or phase < args.ending_phase)):
+            # Copy the data of the next phase to scratch while this phase trains.
+            next_size = stored_size(args, 2 * size)
+            if next_size != source_size:
+                next_path = os.path.join(args.dataset_path, f'{next_size}x{next_size}/')
+                list_files = functools.partial(DATASET_FORMATS[args.data_format].source_files, next_path)
+                stager = BackgroundStager(list_files, os.path.normpath(args.scratch_path + next_path),
+                                          src_dir=next_path, bytes_per_second=args.stage_bandwidth_mb * 2 ** 20,
+                                          verify=not args.no_stage_checksums)
+
+        if args.starting_phase <= phase <= args.shared_memory_phases:
+            npy_data = SharedMemoryDataset(npy_data, create=local_rank == 0, token=run_token,
+                                           num_workers=args.loader_workers)
 
         # # dataset = tf.data.Dataset.from_generator(npy_data.__iter__, npy_data.dtype, npy_data.shape)
         # dataset = tf.data.Dataset.from_tensor_slices(npy_data.scratch_files)
@@ -78,45 +160,51 @@ def main(args, config):
             assert batch_size * global_size <= args.max_global_batch_size
             if verbose:
                 print(f"Using local batch size of {batch_size} and global batch size of {batch_size * global_size}")
-
-        # if args.horovod:
-        #     dataset.shard(hvd.size(), hvd.rank())
-        #
-        # def load(x):
-        #     x = np.load(x.decode())[np.newaxis, ...].astype(np.float32) / 1024 - 1
-        #     return x
-        #
-        # if args.gpu:
-        #     parallel_calls = AUTOTUNE
-        # else:
-        #     parallel_calls = int(os.environ['OMP_NUM_THREADS'])
-        #
-        # dataset = dataset.shuffle(len(npy_data))
-        # dataset = dataset.map(lambda x: tuple(tf.py_func(load, [x], [tf.float32])), num_parallel_calls=parallel_calls)
-        # dataset = dataset.batch(batch_size, drop_remainder=True)
-        # dataset = dataset.repeat()
-        # dataset = dataset.prefetch(AUTOTUNE)
-        # dataset = dataset.make_one_shot_iterator()
-        # data = dataset.get_next()
-        # if len(data) == 1:
-        #     real_image_input = data
-        #     real_label = None
-        # elif len(data) == 2:
-        #     real_image_input, real_label = data
-        # else:
-        #     raise NotImplementedError()
+            # Only phases that are trained get a sampler: skipped phases may have batches larger than
+            # their per-rank shard.
+            sampler = DistributedSampler(len(npy_data), batch_size, rank=global_rank, num_replicas=global_size,
+                                         seed=args.seed, fixed_shards=not args.reshard_every_epoch)
+        else:
+            sampler = None
 
         zdim_base = max(1, final_shape[1] // (2 ** (num_phases - 1)))
         base_shape = (image_channels, zdim_base, 4, 4)
         current_shape = [batch_size, image_channels, *[size * 2 ** (phase - 1) for size in
                                                        base_shape[1:]]]
-        real_image_input = tf.placeholder(shape=current_shape, dtype=tf.float32)
+
+        if args.input_pipeline == 'tf_data':
+            if args.gpu:
+                parallel_calls = AUTOTUNE
+            else:
+                parallel_calls = int(os.environ['OMP_NUM_THREADS'])
+
+            if args.data_format == 'tfrecord':
+                dataset = npy_data.tf_dataset(rank=global_rank, num_replicas=global_size, seed=args.seed,
+                                              parallel_calls=parallel_calls)
+            else:
+                paths = tf.constant(npy_data.scratch_files)
+                dataset = tf.data.Dataset.from_generator(lambda: (i for batch in sampler for i in batch), tf.int64)
+                dataset = dataset.map(lambda i: tf.gather(paths, i))
+                dataset = dataset.map(npy_decoder(npy_data.scratch_files[0]), num_parallel_calls=parallel_calls)
+            dataset = dataset.batch(batch_size, drop_remainder=True)
+            dataset = dataset.prefetch(AUTOTUNE)
+            dataset = dataset.make_one_shot_iterator()
+            raw_image_input = tf.ensure_shape(dataset.get_next(), current_shape)
+            real_image_placeholder = None
+        else:
+            # Batches are fed in the dtype they are stored in, and cast and scaled in the graph.
+            real_image_placeholder = tf.placeholder(shape=current_shape, dtype=tf.as_dtype(npy_data.dtype))
+            raw_image_input = real_image_placeholder
+
+        real_image_input = normalize(raw_image_input, metadata['intercept'], metadata['scale'])
 
         # real_image_input = tf.random.normal([1, batch_size, image_channels, *[size * 2 ** (phase -
         #                                                                                  1) for size in base_shape[1:]]])
         # real_image_input = tf.squeeze(real_image_input, axis=0)
         # real_image_input = tf.ensure_shape(real_image_input, [batch_size, image_channels, *[size * 2 ** (phase - 1) for size in base_shape[1:]]])
-        real_image_input = real_image_input + tf.random.normal(tf.shape(real_image_input)) * .01
+        if args.input_noise > 0:
+            # Off by default: feeding the noised tensor used to bypass this noise, so earlier runs trained without it.
+            real_image_input = real_image_input + tf.random.normal(tf.shape(real_image_input)) * args.input_noise
         real_label = None
 
         if real_label is not None:
@@ -160,11 +248,6 @@ def main(args, config):
         # optimizer_disc = RAdamOptimizer(learning_rate=d_lr, beta1=args.beta1, beta2=args.beta2)
 
         lr_step = tf.Variable(0, name='step', dtype=tf.float32)
-        update_step = lr_step.assign_add(1.0)
-
-        with tf.control_dependencies([update_step]):
-            update_g_lr = g_lr.assign(g_lr * args.g_annealing)
-            update_d_lr = d_lr.assign(d_lr * args.d_annealing)
 
         if args.horovod:
             if args.use_adasum:
@@ -183,11 +266,9 @@ def main(args, config):
             # Alpha init
             init_alpha = alpha.assign(1)
 
-            # Specify alpha update op for mixing phase.
+            # Alpha decrement per step of the mixing phase, applied by mixing_step below.
             num_steps = args.mixing_nimg // (batch_size * global_size)
             alpha_update = 1 / num_steps
-            # noinspection PyTypeChecker
-            update_alpha = alpha.assign(tf.maximum(alpha - alpha_update, 0))
 
         if args.optim_strategy == 'simultaneous':
             gen_loss, disc_loss, gp_loss, gen_sample = forward_simultaneous(
@@ -301,7 +382,8 @@ def main(args, config):
         # train_disc = optimizer_disc.minimize(disc_loss, var_list=disc_vars)
 
         ema = tf.train.ExponentialMovingAverage(decay=args.ema_beta)
-        ema_op = ema.apply(gen_vars)
+        # Only creates the shadow variables, they are updated by the train step ops below.
+        ema.apply(gen_vars)
         # Transfer EMA values to original variables
         ema_update_weights = tf.group(
             [tf.assign(var, ema.average(var)) for var in gen_vars])
@@ -352,6 +434,21 @@ def main(args, config):
 
             merged_summaries = tf.summary.merge_all()
 
+        # The bookkeeping after every step runs in the same session call as the step itself. It waits
+        # for the train ops and for the summaries, which read alpha and the learning rates.
+        with tf.control_dependencies([train_gen, train_disc, merged_summaries]):
+            update_ema = [ema.average(var).assign_sub((1 - args.ema_beta) * (ema.average(var) - var))
+                          for var in gen_vars]
+            update_step = lr_step.assign_add(1.0)
+            with tf.control_dependencies([update_step]):
+                update_g_lr = g_lr.assign(g_lr * args.g_annealing)
+                update_d_lr = d_lr.assign(d_lr * args.d_annealing)
+            # noinspection PyTypeChecker
+            update_alpha = alpha.assign(tf.maximum(alpha - alpha_update, 0))
+
+        mixing_step = tf.group(train_gen, train_disc, update_alpha, update_g_lr, update_d_lr, *update_ema)
+        stabilizing_step = tf.group(train_gen, train_disc, *update_ema)
+
         # Other ops
         init_op = tf.global_variables_initializer()
         assign_starting_alpha = alpha.assign(args.starting_alpha)
@@ -386,8 +483,16 @@ def main(args, config):
             var_list = gen_vars + disc_vars
 
             if phase < args.starting_phase:
+                if hasattr(npy_data, 'close'):
+                    npy_data.close()
                 continue
 
+            if real_image_placeholder is not None:
+                loader = BatchLoader(npy_data, batch_size, num_workers=args.loader_workers,
+                                     prefetch=args.prefetch_batches, sampler=sampler)
+            else:
+                loader = None
+
             if phase == args.starting_phase:
                 sess.run(assign_starting_alpha)
             else:
@@ -410,14 +515,17 @@ def main(args, config):
                     if verbose:
                         saver.save(sess, os.path.join(logdir, f'model_{phase}_ckpt_{global_step}'))
 
-                batch_loc = np.random.randint(0, len(npy_data) - batch_size)
-                batch_paths = npy_data[batch_loc: batch_loc + batch_size]
-                batch = np.stack([np.load(path) for path in batch_paths])
-                batch = batch[:, np.newaxis, ...].astype(np.float32) / 1024 - 1
-
-                _, _, summary, d_loss, g_loss = sess.run(
-                     [train_gen, train_disc, merged_summaries,
-                      disc_loss, gen_loss], feed_dict={real_image_input: batch})
+                if loader is not None:
+                    feed_dict = {real_image_placeholder: next(loader)}
+                    stall_time = loader.last_stall_time
+                else:
+                    feed_dict = None
+                    stall_time = 0
+
+                # alpha_value is the alpha of the next step.
+                _, summary, d_loss, g_loss, alpha_value = sess.run(
+                     [mixing_step, merged_summaries,
+                      disc_loss, gen_loss, update_alpha], feed_dict=feed_dict)
                 global_step += batch_size * global_size
                 local_step += 1
 
@@ -429,6 +537,9 @@ def main(args, config):
                         writer.add_summary(summary, global_step)
                         writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='img_s', simple_value=img_s)]),
                                            global_step)
+                        writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='loader_stall',
+                                                                              simple_value=stall_time)]),
+                                           global_step)
                     # memory_percentage = psutil.Process(os.getpid()).memory_percent()
                     # if not args.gpu:
                     #     memory_percentage = psutil.Process(os.getpid()).memory_percent()
@@ -443,8 +554,9 @@ def main(args, config):
                           f"img/s {img_s:.2f} \t "
                           f"d_loss {d_loss:.4f} \t "
                           f"g_loss {g_loss:.4f} \t "
+                          f"stall {stall_time:.3f}s \t "
                           # f"memory {memory_percentage:.4f} % \t"
-                          f"alpha {alpha.eval():.2f}")
+                          f"alpha {alpha_value:.2f}")
 
                 #     # if take_first_snapshot:
                 #     #     import tracemalloc
@@ -464,12 +576,7 @@ def main(args, config):
                                    + args.mixing_nimg):
                     break
 
-                sess.run(update_alpha)
-                sess.run(ema_op)
-                sess.run(update_d_lr)
-                sess.run(update_g_lr)
-
-                assert alpha.eval() >= 0
+                assert alpha_value >= 0
 
                 # if verbose:
                 #     writer.flush()
@@ -481,7 +588,6 @@ def main(args, config):
 
             while True:
                 start = time.time()
-                assert alpha.eval() == 0
                 if local_step % 2048 == 0 and local_step > 0:
 
                     if args.horovod:
@@ -490,14 +596,17 @@ def main(args, config):
                     if verbose:
                         saver.save(sess, os.path.join(logdir, f'model_{phase}_ckpt_{global_step}'))
 
-                batch_loc = np.random.randint(0, len(npy_data) - batch_size)
-                batch_paths = npy_data[batch_loc: batch_loc + batch_size]
-                batch = np.stack([np.load(path) for path in batch_paths])
-                batch = batch[:, np.newaxis, ...].astype(np.float32) / 1024 - 1
+                if loader is not None:
+                    feed_dict = {real_image_placeholder: next(loader)}
+                    stall_time = loader.last_stall_time
+                else:
+                    feed_dict = None
+                    stall_time = 0
 
-                _, _, summary, d_loss, g_loss = sess.run(
-                    [train_gen, train_disc, merged_summaries,
-                     disc_loss, gen_loss], feed_dict={real_image_input: batch})
+                _, summary, d_loss, g_loss, alpha_value = sess.run(
+                    [stabilizing_step, merged_summaries,
+                     disc_loss, gen_loss, alpha], feed_dict=feed_dict)
+                assert alpha_value == 0
 
                 global_step += batch_size * global_size
                 local_step += 1
@@ -510,6 +619,9 @@ def main(args, config):
                         writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='img_s',
                                                                             simple_value   =img_s)]),
                                         global_step)
+                        writer.add_summary(tf.Summary(value=[tf.Summary.Value(tag='loader_stall',
+                                                                              simple_value=stall_time)]),
+                                           global_step)
                     writer.add_summary(summary, global_step)
                     # memory_percentage = psutil.Process(os.getpid()).memory_percent()
                     # if not args.gpu:
@@ -525,10 +637,9 @@ def main(args, config):
                           f"img/s {img_s:.2f} \t "
                           f"d_loss {d_loss:.4f} \t "
                           f"g_loss {g_loss:.4f} \t "
+                          f"stall {stall_time:.3f}s \t "
                           # f"memory {memory_percentage:.4f} % \t"
-                          f"alpha {alpha.eval():.2f}")
-
-                sess.run(ema_op)
+                          f"alpha {alpha_value:.2f}")
 
                 # if verbose:
                 #     writer.flush()
@@ -554,6 +665,14 @@ def main(args, config):
 
                     break
 
+            if loader is not None:
+                loader.close()
+                if verbose:
+                    print(f"Total loader stall time in phase {phase}: {loader.stall_time:.2f}s")
+            if hasattr(npy_data, 'close'):
+                # Release file handles, decompression pools and shared memory before the next phase.
+                npy_data.close()
+
             # # Calculate metrics.
             # calc_swds: bool = size >= 16
             # calc_ssims: bool = min(npy_data.shape[1:]) >= 16
@@ -698,6 +817,11 @@ if __name__ == '__main__':
     parser.add_argument('--latent_dim', type=int, default=None, required=True)
     parser.add_argument('--network_size', default=None, choices=['xxs', 'xs', 's', 'm', 'l', 'xl', 'xxl'], required=True)
     parser.add_argument('--scratch_path', type=str, default=None, required=True)
+    parser.add_argument('--data_format', default='npy', choices=['npy', 'packed', 'chunked', 'tfrecord', 'hdf5'],
+                        help="'npy': one file per volume, 'packed': one memory-mapped file per phase, "
+                             "'chunked': compressed chunks decompressed in parallel, "
+                             "'tfrecord': sharded TFRecords of raw volumes (requires --input_pipeline tf_data), "
+                             "'hdf5': one {size}x{size}.h5 file per phase, read a batch at a time.")
     parser.add_argument('--base_batch_size', type=int, default=256, help='batch size used in phase 1')
     parser.add_argument('--max_global_batch_size', type=int, default=256)
     parser.add_argument('--mixing_nimg', type=int, default=2 ** 19)
@@ -732,6 +856,30 @@ if __name__ == '__main__':
     parser.add_argument('--num_labels', default=None, type=int)
     parser.add_argument('--g_clipping', default=False, type=bool)
     parser.add_argument('--d_clipping', default=False, type=bool)
+    parser.add_argument('--pyramid', default=False, action='store_true',
+                        help='Compute resolution levels that are not stored from the nearest finer stored level.')
+    parser.add_argument('--pyramid_reduce', default='average', choices=['average', 'absmax', 'lanczos'])
+    parser.add_argument('--pyramid_cache_gb', default=8, type=float,
+                        help='Maximum size of the in-RAM cache of computed levels, per process.')
+    parser.add_argument('--shared_memory_phases', default=0, type=int,
+                        help='Phases up to and including this one are held in node-shared memory.')
+    parser.add_argument('--reshard_every_epoch', default=False, action='store_true',
+                        help='Redraw the split of the dataset over ranks every epoch instead of only shuffling '
+                             'within a fixed per-rank shard.')
+    parser.add_argument('--background_staging', default=False, action='store_true',
+                        help="Copy the next phase's data to scratch while the current phase trains.")
+    parser.add_argument('--stage_bandwidth_mb', default=0, type=float,
+                        help='Bandwidth limit of background staging in MiB/s per node, 0 for none.')
+    parser.add_argument('--no_stage_checksums', default=False, action='store_true',
+                        help='Trust staged files with a matching size and mtime without verifying their CRC32.')
+    parser.add_argument('--input_noise', default=0, type=float,
+                        help='Standard deviation of Gaussian noise added to the normalized real images.')
+    parser.add_argument('--input_pipeline', default='loader', choices=['loader', 'tf_data'],
+                        help="'loader': BatchLoader feeding a placeholder, 'tf_data': in-graph .npy decoding.")
+    parser.add_argument('--loader_workers', default=None, type=int,
+                        help='Number of threads reading batches, defaults to OMP_NUM_THREADS.')
+    parser.add_argument('--prefetch_batches', default=2, type=int,
+                        help='Number of batches read ahead of the training step.')
     # parser.add_argument('--load_phase', default=None, type=int)
     args = parser.parse_args()
 
@@ -752,6 +900,13 @@ if __name__ == '__main__':
         tf.random.set_random_seed(args.seed)
         random.seed(args.seed)
 
+    if args.input_pipeline == 'tf_data' and (args.data_format not in ('npy', 'tfrecord')
+                                            or args.shared_memory_phases > 0 or args.pyramid):
+        raise ValueError("--input_pipeline tf_data requires --data_format npy or tfrecord "
+                         "without --shared_memory_phases or --pyramid.")
+    if args.data_format == 'tfrecord' and args.input_pipeline != 'tf_data':
+        raise ValueError("--data_format tfrecord requires --input_pipeline tf_data.")
+
     if args.architecture in ('stylegan2'):
         assert args.starting_phase == args.ending_phase
 
@@ -0,0 +1,70 @@
+import numpy as np
+
+REDUCTIONS = ('average', 'absmax', 'lanczos')
+
+
+def absmax(a, axis=None):
+    amax = a.max(axis)
+    amin = a.min(axis)
+    return np.where(-amin > amax, amin, amax)
+
+
+def lanczos_kernel(a=3):
+    """Taps of a Lanczos-`a` filter for downsampling by 2. Every output sample lies halfway between
+    two input samples, so the taps are at distances 0.5, 1.5, ..., 2a - 0.5 input samples."""
+    d = np.arange(-2 * a + 0.5, 2 * a)
+    w = np.sinc(d / 2) * np.sinc(d / (2 * a))
+    return w / w.sum()
+
+
+def downsample(array, reduce='average', kernel=None):
+    """Halves every axis of `array` with a separable 1D filter, one axis at a time.
+
+    'average' and 'absmax' reduce pairs of samples and give exactly the same result as a 2x2x2
+    block reduction. Applied repeatedly, they also equal a block reduction by 2 ** n.
+    """
+    if reduce == 'lanczos' and kernel is None:
+        kernel = lanczos_kernel()
+
+    for axis in range(array.ndim):
+        assert array.shape[axis] % 2 == 0, f"Shape {array.shape} not divisible by 2"
+        x = np.moveaxis(array, axis, 0)
+        if reduce == 'average':
+            x = (x[0::2] + x[1::2]) / 2
+        elif reduce == 'absmax':
+            amax = np.maximum(x[0::2], x[1::2])
+            amin = np.minimum(x[0::2], x[1::2])
+            x = np.where(-amin > amax, amin, amax)
+        elif reduce == 'lanczos':
+            pad = len(kernel) // 2 - 1
+            n = x.shape[0] // 2
+            padded = np.pad(x, [(pad, pad)] + [(0, 0)] * (x.ndim - 1), mode='edge')
+            x = sum(w * padded[k: k + 2 * n: 2] for k, w in enumerate(kernel))
+        else:
+            raise ValueError(f"Unknown reduction {reduce}")
+        array = np.moveaxis(x, 0, axis)
+    return array
+
+
+def build_pyramid(array, num_levels, reduce='average'):
+    """Returns `num_levels + 1` float64 levels, where level i is `array` downsampled by 2 ** i.
+
+    Every level is computed from the previous one, so each level costs 1/8th of the one
+    before it rather than a pass over the full-resolution array.
+    """
+    levels = [np.asarray(array, dtype=np.float64)]
+    kernel = lanczos_kernel() if reduce == 'lanczos' else None
+    for _ in range(num_levels):
+        levels.append(downsample(levels[-1], reduce=reduce, kernel=kernel))
+    return levels
+
+
+def downsample_volume(array, factor, reduce='average', clip_max=3072):
+    """Computes a coarser pyramid level from a stored volume, the same way
+    data_scripts/create_lidc_idri_dataset.py does. The result has the dtype of `array`."""
+    if factor == 1:
+        return array
+    num_levels = int(np.log2(factor))
+    assert 2 ** num_levels == factor, f"Factor {factor} is not a power of 2"
+    reduced = build_pyramid(array, num_levels, reduce=reduce)[-1]
+    return np.clip(reduced, 0, clip_max).astype(array.dtype)
@@ -0,0 +1,184 @@
+import os
+import threading
+import time
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from storage import read_json, write_json
+
+MANIFEST = '.staging_manifest.json'
+COMPLETE = '.staging_complete'
+BUFFER_SIZE = 16 * 2 ** 20
+
+
+class Throttle:
+    """Token bucket that limits the combined rate of all copying threads to `bytes_per_second`."""
+    def __init__(self, bytes_per_second, burst=BUFFER_SIZE):
+        super(Throttle, self).__init__()
+        self.rate = bytes_per_second
+        self.burst = max(burst, BUFFER_SIZE)
+        self.tokens = self.burst
+        self.last = time.monotonic()
+        self.lock = threading.Lock()
+
+    def consume(self, n):
+        with self.lock:
+            now = time.monotonic()
+            self.tokens = min(self.burst, self.tokens + (now - self.last) * self.rate)
+            self.last = now
+            self.tokens -= n
+            # Reserve the bytes now and sleep off the debt outside the lock.
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay > 0:
+            time.sleep(delay)
+
+
+def copy_with_checksum(src, dst, throttle=None):
+    """Copies `src` to `dst` through a temporary file, so that `dst` is never partially written,
+    and returns the CRC32 of the contents."""
+    crc = 0
+    tmp_dst = dst + '.tmp'
+    with open(src, 'rb') as fsrc, open(tmp_dst, 'wb') as fdst:
+        while True:
+            buf = fsrc.read(BUFFER_SIZE)
+            if not buf:
+                break
+            if throttle is not None:
+                throttle.consume(len(buf))
+            crc = zlib.crc32(buf, crc)
+            fdst.write(buf)
+    os.replace(tmp_dst, dst)
+    return crc
+
+
+def file_checksum(path):
+    crc = 0
+    with open(path, 'rb') as f:
+        while True:
+            buf = f.read(BUFFER_SIZE)
+            if not buf:
+                return crc
+            crc = zlib.crc32(buf, crc)
+
+
+def read_manifest(dst_dir):
+    try:
+        return read_json(os.path.join(dst_dir, MANIFEST))
+    except FileNotFoundError:
+        return {'files': []}
+
+
+def is_in_place(src_dir, dst_dir):
+    """Whether staging from `src_dir` to `dst_dir` is a no-op, e.g. with --scratch_path /."""
+    return os.path.realpath(src_dir) == os.path.realpath(dst_dir)
+
+
+def stage_files(files, dst_dir, src_dir=None, num_workers=8, stats=None, throttle=None, verify=True):
+    """Copies `files` into `dst_dir` with a thread pool.
+
+    When done, a manifest with the size, mtime and CRC32 of every file is written, followed by a
+    completion marker that waiting processes block on (see `wait_for_stage`). Files whose size
+    and mtime match the manifest of a previous run are not copied again, provided that the staged
+    copy still has the CRC32 in the manifest. `verify=False` skips that check, which saves reading
+    back every staged file but trusts copies of the right size. If `stats` maps file
+    names to (size, mtime), e.g. from a dataset index, the sources are not stat'ed. If `src_dir`,
+    the phase directory the files belong to, is `dst_dir`, nothing is written at all.
+    """
+    if src_dir is not None and is_in_place(src_dir, dst_dir):
+        return []
+
+    os.makedirs(dst_dir, exist_ok=True)
+    # Remove the marker of a previous run first, so nobody waits on it while files are replaced.
+    complete = os.path.join(dst_dir, COMPLETE)
+    if os.path.exists(complete):
+        os.remove(complete)
+    previous = {entry['name']: entry for entry in read_manifest(dst_dir)['files']}
+
+    def stage(src):
+        name = os.path.basename(src)
+        dst = os.path.join(dst_dir, name)
+        if stats is not None:
+            size, mtime = stats[name]
+        else:
+            stat = os.stat(src)
+            size, mtime = stat.st_size, stat.st_mtime
+
+        entry = previous.get(name)
+        if (entry is not None and entry['size'] == size and entry['mtime'] == mtime
+                and os.path.isfile(dst) and os.path.getsize(dst) == size
+                and (not verify or entry.get('crc32') == file_checksum(dst))):
+            return entry, False
+
+        crc = copy_with_checksum(src, dst, throttle)
+        return {'name': name, 'size': size, 'mtime': mtime, 'crc32': crc}, True
+
+    start = time.time()
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        results = list(pool.map(stage, files))
+
+    entries = [entry for entry, _ in results]
+    num_copied = sum(copied for _, copied in results)
+    write_json(os.path.join(dst_dir, MANIFEST), {'files': entries})
+    with open(complete, 'w') as f:
+        f.write(str(time.time()))
+
+    print(f"Staged {num_copied} files ({len(entries) - num_copied} already present) "
+          f"to {dst_dir} in {time.time() - start:.1f}s")
+    return entries
+
+
+def is_staged(dst_dir, names):
+    if not os.path.exists(os.path.join(dst_dir, COMPLETE)):
+        return False
+    staged = set(entry['name'] for entry in read_manifest(dst_dir)['files'])
+    return staged.issuperset(names)
+
+
+def wait_for_stage(dst_dir, names, src_dir=None, max_interval=5):
+    """Blocks until `stage_files` has finished staging `names` from `src_dir` into `dst_dir`.
+
+    Only the completion marker is checked while waiting, so a poll costs a single stat call
+    instead of a listing of the whole directory. Returns at once if `src_dir` is `dst_dir`.
+    """
+    if src_dir is not None and is_in_place(src_dir, dst_dir):
+        return
+    interval = .1
+    while not is_staged(dst_dir, names):
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+
+
+class BackgroundStager:
+    """Runs `stage_files` in a background thread, e.g. for the next phase while this one trains.
+
+    `list_files` is called in the background thread as well, so listing a large directory does
+    not block the caller. With `bytes_per_second`, the copy is throttled so that it does not
+    starve the reads of the running phase. `wait` returns once staging is done; if it is called
+    while files are still being copied, only the remainder is waited on.
+    """
+    def __init__(self, list_files, dst_dir, src_dir=None, bytes_per_second=None, num_workers=2, verify=True):
+        super(BackgroundStager, self).__init__()
+        self.dst_dir = dst_dir
+        self.src_dir = src_dir
+        self.verify = verify
+        self.throttle = Throttle(bytes_per_second) if bytes_per_second else None
+        self.error = None
+        self.thread = threading.Thread(target=self._run, args=(list_files, num_workers), daemon=True)
+        self.thread.start()
+
+    def _run(self, list_files, num_workers):
+        try:
+            stage_files(list_files(), self.dst_dir, src_dir=self.src_dir, num_workers=num_workers,
+                        throttle=self.throttle, verify=self.verify)
+        except Exception as e:
+            self.error = e
+
+    def done(self):
+        return not self.thread.is_alive()
+
+    def wait(self):
+        start = time.time()
+        self.thread.join()
+        if self.error is not None:
+            # Not fatal: the next phase stages whatever is missing itself.
+            print(f"Background staging to {self.dst_dir} failed: {self.error}")
+        return time.time() - start
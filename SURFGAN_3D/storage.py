@@ -0,0 +1,476 @@
+import glob
+import json
+import os
+import socket
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
+
+try:
+    import blosc
+except ImportError:
+    blosc = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+try:
+    import h5py
+except ImportError:
+    h5py = None
+
+DATASET_INDEX = 'index.json'
+PACKED_DATA = 'packed.bin'
+PACKED_INDEX = 'packed.json'
+DATASET_METADATA = 'metadata.json'
+TFRECORD_INDEX = 'tfrecords.json'
+
+# Volumes are stored as HU + 1024 in uint16, and trained on as (x - intercept) / scale.
+DEFAULT_METADATA = {'intercept': 1024, 'scale': 1024}
+
+
+def write_json(path, obj):
+    # Write to a temporary file first so readers never see a half-written index. The name is unique
+    # per process, so concurrent writers of the same file do not replace each other's temporary file.
+    tmp_path = f'{path}.{socket.gethostname()}.{os.getpid()}.tmp'
+    with open(tmp_path, 'w') as f:
+        json.dump(obj, f)
+    os.replace(tmp_path, path)
+
+
+def read_json(path):
+    with open(path) as f:
+        return json.load(f)
+
+
+def read_dataset_metadata(dataset_path):
+    """Reads the metadata.json in the root of a dataset, falling back to DEFAULT_METADATA."""
+    metadata = dict(DEFAULT_METADATA)
+    path = os.path.join(dataset_path, DATASET_METADATA)
+    if os.path.isfile(path):
+        metadata.update(read_json(path))
+    return metadata
+
+
+def describe_volume(path, stat):
+    array = np.load(path, mmap_mode='r')
+    return {
+        'name': os.path.basename(path),
+        'shape': list(array.shape),
+        'dtype': array.dtype.str,
+        'size': stat.st_size,
+        'mtime': stat.st_mtime,
+        'min': array.min().item(),
+        'max': array.max().item(),
+    }
+
+
+def build_index(npy_dir, previous=None, num_workers=8):
+    """Describes every .npy file in `npy_dir` by name, shape, dtype, size, mtime, min and max.
+
+    Entries of `previous` whose size and mtime still match are reused, so only new or changed
+    files are opened. The directory is listed once with os.scandir, which also provides the
+    stat results without extra calls on most filesystems.
+    """
+    previous = {e['name']: e for e in previous['files']} if previous is not None else {}
+
+    with os.scandir(npy_dir) as it:
+        entries = sorted((e for e in it if e.name.endswith('.npy')), key=lambda e: e.name)
+
+    def describe(entry):
+        stat = entry.stat()
+        old = previous.get(entry.name)
+        if old is not None and old['size'] == stat.st_size and old['mtime'] == stat.st_mtime:
+            return old
+        return describe_volume(entry.path, stat)
+
+    with ThreadPoolExecutor(max_workers=num_workers) as pool:
+        files = list(pool.map(describe, entries))
+    return {'files': files}
+
+
+def update_index(npy_dir, fallback_dir=None):
+    """Loads the index of `npy_dir`, brings it up to date and writes it back.
+
+    The index is stored in `npy_dir` itself, or in `fallback_dir` if `npy_dir` is read-only.
+    """
+    index_dir = npy_dir if os.access(npy_dir, os.W_OK) or fallback_dir is None else fallback_dir
+    index_path = os.path.join(index_dir, DATASET_INDEX)
+
+    previous = None
+    for path in (os.path.join(npy_dir, DATASET_INDEX), index_path):
+        if os.path.isfile(path):
+            previous = read_json(path)
+            break
+
+    index = build_index(npy_dir, previous)
+    if index != previous:
+        os.makedirs(index_dir, exist_ok=True)
+        write_json(index_path, index)
+    return index
+
+
+def write_packed(npy_dir, output_dir):
+    """Packs all .npy files in `npy_dir` into one contiguous array plus a JSON index of
+    offsets and shapes."""
+    npy_files = sorted(glob.glob(os.path.join(npy_dir, '*.npy')))
+    if len(npy_files) == 0:
+        raise ValueError(f"No .npy files found in {npy_dir}")
+
+    os.makedirs(output_dir, exist_ok=True)
+
+    headers = [np.load(f, mmap_mode='r') for f in npy_files]
+    dtype = headers[0].dtype
+    assert all(h.dtype == dtype for h in headers), "All volumes must have the same dtype."
+
+    shapes = [list(h.shape) for h in headers]
+    nbytes = [h.nbytes for h in headers]
+    offsets = np.concatenate([[0], np.cumsum(nbytes)[:-1]]).tolist()
+    del headers
+
+    data = np.memmap(os.path.join(output_dir, PACKED_DATA), dtype=np.uint8, mode='w+',
+                     shape=(sum(nbytes),))
+    for f, offset, n in zip(npy_files, offsets, nbytes):
+        data[offset: offset + n] = np.load(f).view(np.uint8).reshape(-1)
+    data.flush()
+    del data
+
+    index = {
+        'dtype': dtype.str,
+        'files': [os.path.basename(f) for f in npy_files],
+        'shapes': shapes,
+        'offsets': offsets,
+    }
+    write_json(os.path.join(output_dir, PACKED_INDEX), index)
+    return index
+
+
+class PackedVolumes:
+    """Read-only, memory-mapped view on a directory written by `write_packed`.
+
+    If all volumes have the same shape, the data is exposed as a single (N, ...) array so
+    that a batch is a zero-copy slice or a single gather.
+    """
+    def __init__(self, packed_dir):
+        super(PackedVolumes, self).__init__()
+        index = read_json(os.path.join(packed_dir, PACKED_INDEX))
+
+        self.files = index['files']
+        self.shapes = [tuple(s) for s in index['shapes']]
+        self.offsets = index['offsets']
+        self.dtype = np.dtype(index['dtype'])
+        self.data = np.memmap(os.path.join(packed_dir, PACKED_DATA), dtype=self.dtype, mode='r')
+
+        if len(set(self.shapes)) == 1:
+            self.array = self.data.reshape((len(self.files), *self.shapes[0]))
+        else:
+            self.array = None
+
+    def __getitem__(self, idx):
+        if self.array is not None:
+            return self.array[idx]
+
+        start = self.offsets[idx] // self.dtype.itemsize
+        stop = start + int(np.prod(self.shapes[idx]))
+        return self.data[start: stop].reshape(self.shapes[idx])
+
+    def read_box(self, idx, slices):
+        # Only the pages of the memory map that overlap the box are read.
+        return np.array(self[idx][slices])
+
+    def take(self, indices):
+        if self.array is not None:
+            return self.array[np.asarray(indices)]
+        return np.stack([self[i] for i in indices])
+
+    def __len__(self):
+        return len(self.files)
+
+
+CHUNKED_DATA = 'chunks.bin'
+CHUNKED_INDEX = 'chunks.json'
+
+
+def compress(buf, codec, level, itemsize):
+    if codec == 'zlib':
+        return zlib.compress(buf, level)
+    elif codec == 'blosc':
+        return blosc.compress(buf, typesize=itemsize, clevel=level, shuffle=blosc.SHUFFLE, cname='zstd')
+    elif codec == 'zstd':
+        return zstandard.ZstdCompressor(level=level).compress(buf)
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+
+
+def decompress(buf, codec):
+    if codec == 'zlib':
+        return zlib.decompress(buf)
+    elif codec == 'blosc':
+        return blosc.decompress(buf)
+    elif codec == 'zstd':
+        return zstandard.ZstdDecompressor().decompress(buf)
+    else:
+        raise ValueError(f"Unknown codec {codec}")
+
+
+def compress_volume(array, chunk_depth, codec, level):
+    """Splits `array` along its first axis into chunks of `chunk_depth` slices, compressed independently."""
+    array = np.ascontiguousarray(array)
+    return [compress(array[start: start + chunk_depth].tobytes(), codec, level, array.dtype.itemsize)
+            for start in range(0, array.shape[0], chunk_depth)]
+
+
+class ChunkedWriter:
+    """Appends volumes to a chunked, compressed store.
+
+    Every volume is split along its first (depth) axis into chunks of `chunk_depth` slices that
+    are compressed independently, so a reader can decompress them in parallel. CT volumes are
+    mostly constant padding, which compresses very well. Pass the `state` of an interrupted
+    writer as `resume` to continue appending where it stopped.
+    """
+    def __init__(self, output_dir, chunk_depth=8, codec='zlib', level=3, resume=None):
+        super(ChunkedWriter, self).__init__()
+        if codec == 'blosc' and blosc is None:
+            raise ImportError("The blosc codec requires the blosc package.")
+        if codec == 'zstd' and zstandard is None:
+            raise ImportError("The zstd codec requires the zstandard package.")
+
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.chunk_depth = chunk_depth
+        self.codec = codec
+        self.level = level
+        if resume is None:
+            self.index = {'codec': codec, 'chunk_depth': chunk_depth, 'dtype': None, 'shape': None,
+                          'files': [], 'chunks': []}
+            self.offset = 0
+            self.file = open(os.path.join(output_dir, CHUNKED_DATA), 'wb')
+        else:
+            self.index = resume['index']
+            self.offset = resume['offset']
+            # Drop whatever was written after the state was taken.
+            self.file = open(os.path.join(output_dir, CHUNKED_DATA), 'r+b')
+            self.file.truncate(self.offset)
+            self.file.seek(self.offset)
+
+    def append(self, name, array):
+        self.append_chunks(name, array.shape, array.dtype,
+                           compress_volume(array, self.chunk_depth, self.codec, self.level))
+
+    def append_chunks(self, name, shape, dtype, bufs):
+        """Appends a volume that was already compressed with `compress_volume`, e.g. in another process."""
+        if self.index['shape'] is None:
+            self.index['shape'] = list(shape)
+            self.index['dtype'] = np.dtype(dtype).str
+        assert list(shape) == self.index['shape'], "All volumes must have the same shape."
+        assert np.dtype(dtype).str == self.index['dtype'], "All volumes must have the same dtype."
+
+        chunks = []
+        for buf in bufs:
+            self.file.write(buf)
+            chunks.append([self.offset, len(buf)])
+            self.offset += len(buf)
+
+        self.index['files'].append(name)
+        self.index['chunks'].append(chunks)
+
+    def state(self):
+        self.file.flush()
+        return {'index': self.index, 'offset': self.offset}
+
+    def close(self):
+        self.file.close()
+        write_json(os.path.join(self.output_dir, CHUNKED_INDEX), self.index)
+        return self.index
+
+
+def write_chunked(npy_dir, output_dir, chunk_depth=8, codec='zlib', level=3):
+    npy_files = sorted(glob.glob(os.path.join(npy_dir, '*.npy')))
+    if len(npy_files) == 0:
+        raise ValueError(f"No .npy files found in {npy_dir}")
+
+    writer = ChunkedWriter(output_dir, chunk_depth=chunk_depth, codec=codec, level=level)
+    for f in npy_files:
+        writer.append(os.path.basename(f), np.load(f))
+    return writer.close()
+
+
+class ChunkedVolumes:
+    """Reads a store written by `ChunkedWriter`, decompressing chunks in a thread pool straight
+    into a preallocated output buffer."""
+    def __init__(self, chunked_dir, num_workers=None):
+        super(ChunkedVolumes, self).__init__()
+        if num_workers is None:
+            num_workers = int(os.environ.get('OMP_NUM_THREADS', 1))
+
+        index = read_json(os.path.join(chunked_dir, CHUNKED_INDEX))
+        self.files = index['files']
+        self.chunks = index['chunks']
+        self.codec = index['codec']
+        self.chunk_depth = index['chunk_depth']
+        self.shape = tuple(index['shape'])
+        self.dtype = np.dtype(index['dtype'])
+
+        # os.pread does not move a shared file offset, so threads can read concurrently.
+        self.fd = os.open(os.path.join(chunked_dir, CHUNKED_DATA), os.O_RDONLY)
+        self.pool = ThreadPoolExecutor(max_workers=num_workers)
+
+    def _read_chunk(self, idx, chunk, out, first_chunk=0):
+        # `out` holds the chunks from `first_chunk` onwards.
+        offset, length = self.chunks[idx][chunk]
+        buf = decompress(os.pread(self.fd, length, offset), self.codec)
+        start = (chunk - first_chunk) * self.chunk_depth
+        out[start: start + self.chunk_depth] = np.frombuffer(buf, dtype=self.dtype).reshape(-1, *self.shape[1:])
+
+    def read_into(self, idx, out):
+        futures = [self.pool.submit(self._read_chunk, idx, chunk, out) for chunk in range(len(self.chunks[idx]))]
+        for future in futures:
+            future.result()
+        return out
+
+    def __getitem__(self, idx):
+        return self.read_into(idx, np.empty(self.shape, dtype=self.dtype))
+
+    def read_box(self, idx, slices):
+        """Reads the sub-volume `slices` (one slice per axis), decompressing only the chunks that
+        overlap it along depth."""
+        depth = slices[0]
+        first_chunk = depth.start // self.chunk_depth
+        last_chunk = (depth.stop - 1) // self.chunk_depth
+        start = first_chunk * self.chunk_depth
+        stop = min((last_chunk + 1) * self.chunk_depth, self.shape[0])
+
+        out = np.empty((stop - start, *self.shape[1:]), dtype=self.dtype)
+        futures = [self.pool.submit(self._read_chunk, idx, chunk, out, first_chunk)
+                   for chunk in range(first_chunk, last_chunk + 1)]
+        for future in futures:
+            future.result()
+        return out[(slice(depth.start - start, depth.stop - start), *slices[1:])]
+
+    def take(self, indices, out=None):
+        if out is None:
+            out = np.empty((len(indices), *self.shape), dtype=self.dtype)
+        futures = [self.pool.submit(self._read_chunk, idx, chunk, out[i])
+                   for i, idx in enumerate(indices) for chunk in range(len(self.chunks[idx]))]
+        for future in futures:
+            future.result()
+        return out
+
+    def __len__(self):
+        return len(self.files)
+
+    def close(self):
+        self.pool.shutdown()
+        os.close(self.fd)
+
+
+HDF5_DATA = 'data'
+HDF5_NAMES = 'names'
+
+
+def hdf5_path(phase_dir):
+    """Every resolution is stored in a {size}x{size}.h5 file next to where its phase directory would be."""
+    return os.path.normpath(phase_dir) + '.h5'
+
+
+def compress_hdf5_chunk(array, level=None):
+    """Encodes a volume as one chunk of a dataset created by `Hdf5Writer` with the same `level`.
+
+    Runs in any process, so the preprocessing pool does the compression and the writing process only
+    stores the bytes. HDF5's gzip filter stores zlib streams, so zlib.compress produces valid chunks.
+    """
+    buf = np.ascontiguousarray(array).tobytes()
+    return zlib.compress(buf, level) if level else buf
+
+
+class Hdf5Writer:
+    """Appends volumes to an HDF5 file with one dataset of shape (N, D, H, W) and one chunk per volume.
+
+    Chunks from `compress_hdf5_chunk` are written as they are with H5Dwrite_chunk, bypassing the
+    filter pipeline. The name of every volume is stored alongside; volumes whose name is already
+    in the file are skipped, so an interrupted writer can be resumed by opening the file again.
+    """
+    def __init__(self, path, shape, dtype, level=None):
+        super(Hdf5Writer, self).__init__()
+        if h5py is None:
+            raise ImportError("The hdf5 format requires the h5py package.")
+        self.level = level
+        self.shape = tuple(shape)
+        self.dtype = np.dtype(dtype)
+
+        if os.path.isfile(path):
+            self.file = h5py.File(path, 'r+')
+            self.data = self.file[HDF5_DATA]
+            self.names = self.file[HDF5_NAMES]
+            assert self.data.shape[1:] == self.shape and self.data.dtype == self.dtype, \
+                f"{path} holds volumes of another shape or dtype."
+            # A volume counts once its name is written, drop volumes that were cut off before that.
+            count = len(self.names)
+            while count > 0 and not self.names[count - 1]:
+                count -= 1
+            self.data.resize(count, axis=0)
+            self.names.resize(count, axis=0)
+        else:
+            os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+            self.file = h5py.File(path, 'w')
+            self.data = self.file.create_dataset(HDF5_DATA, (0, *self.shape), self.dtype,
+                                                 maxshape=(None, *self.shape), chunks=(1, *self.shape),
+                                                 compression='gzip' if level else None,
+                                                 compression_opts=level if level else None)
+            self.names = self.file.create_dataset(HDF5_NAMES, (0,), h5py.special_dtype(vlen=str),
+                                                  maxshape=(None,))
+        self.written = set(self.read_names())
+
+    def read_names(self):
+        return [n.decode() if isinstance(n, bytes) else n for n in self.names[:]]
+
+    def append_chunk(self, name, buf):
+        if name in self.written:
+            return
+        count = len(self.data)
+        self.data.resize(count + 1, axis=0)
+        self.data.id.write_direct_chunk((count, *[0] * len(self.shape)), buf)
+        self.names.resize(count + 1, axis=0)
+        self.names[count] = name
+        self.file.flush()
+        self.written.add(name)
+
+    def append(self, name, array):
+        assert array.shape == self.shape and array.dtype == self.dtype, "All volumes must have the same shape and dtype."
+        self.append_chunk(name, compress_hdf5_chunk(array, self.level))
+
+    def close(self):
+        self.file.close()
+
+
+class Hdf5Volumes:
+    """Reads a file written by `Hdf5Writer`. A batch is fetched with one fancy-index read, which
+    HDF5 serves chunk by chunk without a file per volume."""
+    def __init__(self, path):
+        super(Hdf5Volumes, self).__init__()
+        if h5py is None:
+            raise ImportError("The hdf5 format requires the h5py package.")
+        self.file = h5py.File(path, 'r')
+        self.data = self.file[HDF5_DATA]
+        self.files = [n.decode() if isinstance(n, bytes) else n for n in self.file[HDF5_NAMES][:]]
+        self.shape = self.data.shape[1:]
+        self.dtype = self.data.dtype
+
+    def __getitem__(self, idx):
+        return self.data[idx]
+
+    def read_box(self, idx, slices):
+        return self.data[(idx, *slices)]
+
+    def take(self, indices):
+        # h5py only accepts increasing, unique indices; read those and restore the order.
+        unique, inverse = np.unique(np.asarray(indices), return_inverse=True)
+        return self.data[unique][inverse]
+
+    def __len__(self):
+        return len(self.data)
+
+    def close(self):
+        self.file.close()
@@ -104,6 +104,42 @@ def uniform_box_sampler(arr, min_width, max_width):
     return slices, arr[slices]
 
 
+def sample_box(shape, min_width, max_width, random_state=np.random):
+    """
+    Samples a box that lies within a volume of `shape`, like `uniform_box_sampler`, but without
+    reading the volume, so that only the box itself has to be read from storage.
+
+    Parameters:
+    -----------
+    shape : tuple
+        The shape of the volume to sample a box from
+    min_width : int or tuple
+        The minimum width of the box along a given axis.
+    max_width : int or tuple
+        The maximum width of the box along a given axis.
+    random_state : np.random.RandomState
+
+    Returns:
+    --------
+    slices :: tuple of slice objects
+    """
+    if not isinstance(min_width, (tuple, list)):
+        min_width = (min_width,) * len(shape)
+    if not isinstance(max_width, (tuple, list)):
+        max_width = (max_width,) * len(shape)
+    assert len(min_width) == len(max_width) == len(shape), 'Dimensions of widths and `shape` must match'
+    if any(mn > min(mx, dim) for dim, mn, mx in zip(shape, min_width, max_width)):
+        raise ValueError(f"Cannot sample a box of width {tuple(min_width)} to {tuple(max_width)} "
+                         f"from a volume of shape {tuple(shape)}.")
+
+    slices = []
+    for dim, mn, mx in zip(shape, min_width, max_width):
+        width = random_state.randint(mn, min(mx, dim) + 1)
+        start = random_state.randint(0, dim - width + 1)
+        slices.append(slice(start, start + width))
+    return tuple(slices)
+
+
 class MPMap:
     def __init__(self, f):
         self.pool = Pool(int(os.environ['OMP_NUM_THREADS']))
@@ -0,0 +1,570 @@
+"""Converts a dataset of {size}x{size} phases from one storage format to another.
+
+Volumes are streamed through a process pool in blocks of about --block_mb, so no worker holds more
+than one block in memory. Targets record which blocks are written, so running the same command
+again after an interruption only converts what is missing.
+
+    python data_scripts/convert.py <src> <dst> --from npy --to packed
+
+Formats:
+- npy: one .npy file per volume.
+- pt: one torch .pt file per volume. uint16 volumes are saved as int16, see pgan_pytorch/data.py.
+- packed: packed.bin plus packed.json, see storage.write_packed.
+- chunked: chunks.bin plus chunks.json, see storage.ChunkedWriter.
+- tfrecord: shards of raw volume bytes plus tfrecords.json, see process_lidc_idri_data.py. Every
+  block becomes one shard. Older record directories without an index, holding one float example
+  per file, can be read as well; their normalized values are mapped back to uint16 HU + 1024.
+- hdf5: one {size}x{size}.h5 file per phase, see storage.Hdf5Writer. Workers compress the chunks,
+  the main process only stores them.
+"""
+import argparse
+import glob
+import os
+import shutil
+import sys
+import warnings
+from multiprocessing import Pool
+import numpy as np
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SURFGAN_3D'))
+from storage import (read_json, write_json, read_dataset_metadata, compress_volume, compress_hdf5_chunk, ChunkedWriter,
+                     ChunkedVolumes, PackedVolumes, Hdf5Writer, Hdf5Volumes, DATASET_METADATA, PACKED_DATA,
+                     PACKED_INDEX, CHUNKED_INDEX, TFRECORD_INDEX)
+
+try:
+    import torch
+except ImportError:
+    torch = None
+
+try:
+    import tensorflow as tf
+except ImportError:
+    tf = None
+
+FORMATS = ('npy', 'pt', 'packed', 'chunked', 'tfrecord', 'hdf5')
+PROGRESS = '.convert_progress.json'
+
+
+def phase_path(root, fmt, pattern, size):
+    path = os.path.join(root, pattern.format(size=size))
+    return path + '.h5' if fmt == 'hdf5' else path
+
+
+def stem(name):
+    return os.path.splitext(os.path.basename(name))[0]
+
+
+def save_atomic(path, save):
+    tmp_path = path + '.tmp'
+    save(tmp_path)
+    os.replace(tmp_path, path)
+
+
+class Source:
+    """Reads the volumes of one phase. Subclasses set `stems`, `shape` and `dtype` and implement
+    `__len__` and `load` or `read`."""
+    def blocks(self, block_size):
+        return [(start, min(start + block_size, len(self))) for start in range(0, len(self), block_size)]
+
+    def read(self, start, stop):
+        return [self.load(i) for i in range(start, stop)]
+
+    def close(self):
+        pass
+
+
+class NpySource(Source):
+    extension = '.npy'
+
+    def __init__(self, path, size, metadata):
+        super(NpySource, self).__init__()
+        self.files = sorted(glob.glob(os.path.join(path, '*' + self.extension)))
+        if len(self.files) == 0:
+            raise ValueError(f"No {self.extension} files found in {path}")
+        self.stems = [stem(f) for f in self.files]
+        first = self.load(0)
+        self.shape, self.dtype = first.shape, first.dtype
+
+    def __len__(self):
+        return len(self.files)
+
+    def load(self, idx):
+        return np.load(self.files[idx], mmap_mode='r')
+
+
+class PtSource(NpySource):
+    extension = '.pt'
+
+    def __init__(self, path, size, metadata):
+        if torch is None:
+            raise ImportError("Reading .pt files requires torch.")
+        # .pt files hold uint16 volumes as int16, the dataset metadata tells them apart.
+        self.stored_dtype = np.dtype(metadata.get('dtype', 'int16'))
+        super(PtSource, self).__init__(path, size, metadata)
+
+    def load(self, idx):
+        array = torch.load(self.files[idx]).numpy()
+        if array.dtype == np.int16 and self.stored_dtype == np.uint16:
+            array = array.view(np.uint16)
+        return array
+
+
+class PackedSource(Source):
+    def __init__(self, path, size, metadata):
+        super(PackedSource, self).__init__()
+        self.volumes = PackedVolumes(path)
+        self.stems = [stem(f) for f in self.volumes.files]
+        self.shape, self.dtype = self.volumes.shapes[0], self.volumes.dtype
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def load(self, idx):
+        return self.volumes[idx]
+
+
+class ChunkedSource(Source):
+    def __init__(self, path, size, metadata):
+        super(ChunkedSource, self).__init__()
+        # Every process of the pool decompresses one block, so one thread per reader is enough.
+        self.volumes = ChunkedVolumes(path, num_workers=1)
+        self.stems = [stem(f) for f in self.volumes.files]
+        self.shape, self.dtype = self.volumes.shape, self.volumes.dtype
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def read(self, start, stop):
+        return list(self.volumes.take(range(start, stop)))
+
+    def close(self):
+        self.volumes.close()
+
+
+class TFRecordSource(Source):
+    """Blocks are the shards of the source, every shard is read sequentially by one worker."""
+    def __init__(self, path, size, metadata):
+        super(TFRecordSource, self).__init__()
+        if tf is None:
+            raise ImportError("Reading TFRecords requires tensorflow.")
+        self.size = size
+        self.intercept, self.scale = metadata['intercept'], metadata['scale']
+        if os.path.isfile(os.path.join(path, TFRECORD_INDEX)):
+            index = read_json(os.path.join(path, TFRECORD_INDEX))
+            self.compression = index['compression']
+            self.dtype = np.dtype(index['dtype'])
+            self._shape = tuple(index['shape'])
+            counts = [shard['num_examples'] for shard in index['shards']]
+            files = [os.path.join(path, shard['file']) for shard in index['shards']]
+        else:
+            # Written by the old pipeline: one uncompressed example per file, normalized to float32.
+            # They are converted back to the uint16 the trainer expects, see `parse`.
+            self.compression = ''
+            self.dtype = np.dtype(np.uint16)
+            self._shape = None
+            files = sorted(glob.glob(os.path.join(path, '*.tfrecord')))
+            counts = [1] * len(files)
+
+        starts = np.concatenate([[0], np.cumsum(counts)]).tolist()
+        self.shards = {start: (f, start, stop) for f, start, stop in zip(files, starts[:-1], starts[1:])}
+        self.num_examples = starts[-1]
+        self.stems = [f'{i:04}' for i in range(self.num_examples)]
+
+    @property
+    def shape(self):
+        # Old record directories have no index. Only the main process needs the shape, so only it
+        # decodes an example to learn it.
+        if self._shape is None:
+            self._shape = self.read(0, 1)[0].shape
+        return self._shape
+
+    def __len__(self):
+        return self.num_examples
+
+    def blocks(self, block_size):
+        return [(start, stop) for _, start, stop in self.shards.values()]
+
+    def parse(self, record):
+        feature = tf.train.Example.FromString(record).features.feature
+        image = feature['image']
+        if image.bytes_list.value:
+            array = np.frombuffer(image.bytes_list.value[0], dtype=self.dtype)
+        else:
+            # The old pipeline stored HU / 1024, which is already the trainer's (x - intercept) / scale
+            # of x = HU + 1024. Undo it, so that the normalization is not applied twice.
+            array = np.array(image.float_list.value, dtype=np.float32)
+            array = np.clip(np.rint(array * self.scale + self.intercept), 0, 3072).astype(np.uint16)
+        if 'shape' in feature:
+            return array.reshape(feature['shape'].int64_list.value)
+        return array.reshape(-1, self.size, self.size)
+
+    def read(self, start, stop):
+        path, shard_start, shard_stop = self.shards[start]
+        assert (shard_start, shard_stop) == (start, stop), "Blocks must be whole shards."
+        records = tf.compat.v1.io.tf_record_iterator(path, tf.io.TFRecordOptions(self.compression or None))
+        return [self.parse(record) for record in records]
+
+
+class Hdf5Source(Source):
+    def __init__(self, path, size, metadata):
+        super(Hdf5Source, self).__init__()
+        self.volumes = Hdf5Volumes(path)
+        self.stems = [stem(f) for f in self.volumes.files]
+        self.shape, self.dtype = self.volumes.shape, self.volumes.dtype
+
+    def __len__(self):
+        return len(self.volumes)
+
+    def read(self, start, stop):
+        # One read of all the volumes of the block.
+        return list(self.volumes[start: stop])
+
+    def close(self):
+        self.volumes.close()
+
+
+SOURCES = {
+    'npy': NpySource,
+    'pt': PtSource,
+    'packed': PackedSource,
+    'chunked': ChunkedSource,
+    'tfrecord': TFRecordSource,
+    'hdf5': Hdf5Source,
+}
+
+
+def load_progress(progress_path, header):
+    """The progress of an interrupted conversion, or None if there is none or it was a conversion of
+    volumes with a different shape, dtype or count."""
+    if not os.path.isfile(progress_path):
+        return None
+    progress = read_json(progress_path)
+    if progress['header'] != header:
+        return None
+    progress['done'] = set(tuple(block) for block in progress['done'])
+    return progress
+
+
+class NpyTarget:
+    """Writes one file per volume. A volume is done once its file exists."""
+    extension = '.npy'
+    ordered = False
+
+    def __init__(self, path, source, blocks, args):
+        super(NpyTarget, self).__init__()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        existing = set(os.listdir(path))
+        self.done = set((start, stop) for start, stop in blocks
+                        if all(s + self.extension in existing for s in source.stems[start: stop]))
+
+    def save(self, path, array):
+        # Through a file object, np.save would append .npy to the temporary name.
+        with open(path, 'wb') as f:
+            np.save(f, array)
+
+    def write_block(self, start, stop, stems, arrays):
+        for name, array in zip(stems, arrays):
+            # Save to a temporary file so that an interrupted write is not mistaken for a done one.
+            save_atomic(os.path.join(self.path, name + self.extension),
+                        lambda tmp_path: self.save(tmp_path, array))
+
+    def commit(self, block, payload):
+        pass
+
+    def close(self):
+        pass
+
+
+class PtTarget(NpyTarget):
+    extension = '.pt'
+
+    def __init__(self, path, source, blocks, args):
+        if torch is None:
+            raise ImportError("Writing .pt files requires torch.")
+        super(PtTarget, self).__init__(path, source, blocks, args)
+
+    def save(self, path, array):
+        if array.dtype == np.uint16:
+            # torch has no uint16. The volumes are stored as HU + 1024 <= 3072, so viewing them as
+            # int16 is exact.
+            array = array.view(np.int16)
+        with warnings.catch_warnings():
+            # Wraps the memory map of the source without a copy. torch warns that it is read-only,
+            # but the tensor is only read by torch.save.
+            warnings.simplefilter('ignore', UserWarning)
+            tensor = torch.from_numpy(array)
+        with open(path, 'wb') as f:
+            torch.save(tensor, f)
+
+
+class PackedTarget:
+    """Workers write their blocks straight into a preallocated packed.bin through memory maps."""
+    ordered = False
+
+    def __init__(self, path, source, blocks, args):
+        super(PackedTarget, self).__init__()
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.progress_path = os.path.join(path, PROGRESS)
+        self.shape = tuple(source.shape)
+        self.dtype = np.dtype(source.dtype)
+        self.stems = source.stems
+        self.volume_bytes = int(np.prod(self.shape)) * self.dtype.itemsize
+        self.header = {'shape': list(self.shape), 'dtype': self.dtype.str, 'num_volumes': len(source)}
+
+        progress = load_progress(self.progress_path, self.header)
+        if progress is not None:
+            self.done = progress['done']
+        elif os.path.isfile(os.path.join(path, PACKED_INDEX)):
+            self.done = set(blocks)
+        else:
+            self.done = set()
+            # Allocating the file with truncate leaves it sparse until the blocks are written.
+            with open(os.path.join(path, PACKED_DATA), 'wb') as f:
+                f.truncate(len(source) * self.volume_bytes)
+            self.save_progress()
+
+    def save_progress(self, **state):
+        write_json(self.progress_path, {'header': self.header, 'done': sorted(self.done), **state})
+
+    def write_block(self, start, stop, stems, arrays):
+        data = np.memmap(os.path.join(self.path, PACKED_DATA), dtype=self.dtype, mode='r+',
+                         offset=start * self.volume_bytes, shape=(stop - start, *self.shape))
+        for i, array in enumerate(arrays):
+            assert array.shape == self.shape, "All volumes must have the same shape."
+            data[i] = array
+        data.flush()
+        del data
+
+    def commit(self, block, payload):
+        self.done.add(block)
+        self.save_progress()
+
+    def close(self):
+        index = {
+            'dtype': self.dtype.str,
+            'files': [s + '.npy' for s in self.stems],
+            'shapes': [list(self.shape)] * len(self.stems),
+            'offsets': [i * self.volume_bytes for i in range(len(self.stems))],
+        }
+        write_json(os.path.join(self.path, PACKED_INDEX), index)
+        if os.path.isfile(self.progress_path):
+            os.remove(self.progress_path)
+
+
+class ChunkedTarget(PackedTarget):
+    """Workers compress their blocks, the main process appends the chunks in order."""
+    ordered = True
+
+    def __init__(self, path, source, blocks, args):
+        self.path = path
+        self.progress_path = os.path.join(path, PROGRESS)
+        self.shape = tuple(source.shape)
+        self.dtype = np.dtype(source.dtype)
+        self.stems = source.stems
+        self.header = {'shape': list(self.shape), 'dtype': self.dtype.str, 'num_volumes': len(source)}
+        self.chunk_depth, self.codec, self.level = args.chunk_depth, args.codec, args.level
+
+        progress = load_progress(self.progress_path, self.header)
+        self.writer = None
+        if progress is not None:
+            self.done = progress['done']
+            self.writer = ChunkedWriter(path, self.chunk_depth, self.codec, self.level, resume=progress['writer'])
+        elif os.path.isfile(os.path.join(path, CHUNKED_INDEX)):
+            self.done = set(blocks)
+        else:
+            self.done = set()
+            self.writer = ChunkedWriter(path, self.chunk_depth, self.codec, self.level)
+            self.save_progress(writer=self.writer.state())
+
+    def __getstate__(self):
+        # Workers only compress, the open data file stays in the main process.
+        state = self.__dict__.copy()
+        state['writer'] = None
+        return state
+
+    def write_block(self, start, stop, stems, arrays):
+        return [compress_volume(array, self.chunk_depth, self.codec, self.level) for array in arrays]
+
+    def commit(self, block, payload):
+        start, stop = block
+        for i, bufs in zip(range(start, stop), payload):
+            self.writer.append_chunks(self.stems[i] + '.npy', self.shape, self.dtype, bufs)
+        self.done.add(block)
+        self.save_progress(writer=self.writer.state())
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+        if os.path.isfile(self.progress_path):
+            os.remove(self.progress_path)
+
+
+class TFRecordTarget:
+    """Every block is written as one shard by one worker. A shard is done once its file exists."""
+    ordered = False
+
+    def __init__(self, path, source, blocks, args):
+        super(TFRecordTarget, self).__init__()
+        if tf is None:
+            raise ImportError("Writing TFRecords requires tensorflow.")
+        os.makedirs(path, exist_ok=True)
+        self.path = path
+        self.blocks = blocks
+        self.compression = args.tfrecord_compression if args.tfrecord_compression != 'none' else ''
+        self.shape = tuple(source.shape)
+        self.dtype = np.dtype(source.dtype)
+        existing = set(os.listdir(path))
+        self.done = set(block for block in blocks if self.shard_name(*block) in existing)
+
+    @staticmethod
+    def shard_name(start, stop):
+        return f'{start:05}-{stop:05}.tfrecord'
+
+    def write_block(self, start, stop, stems, arrays):
+        def save(tmp_path):
+            with tf.io.TFRecordWriter(tmp_path, tf.io.TFRecordOptions(self.compression or None)) as writer:
+                for name, array in zip(stems, arrays):
+                    example = tf.train.Example(features=tf.train.Features(feature={
+                        'image': tf.train.Feature(bytes_list=tf.train.BytesList(
+                            value=[np.ascontiguousarray(array, dtype=self.dtype).tobytes()])),
+                        'shape': tf.train.Feature(int64_list=tf.train.Int64List(value=array.shape)),
+                        'path': tf.train.Feature(bytes_list=tf.train.BytesList(value=[name.encode()])),
+                    }))
+                    writer.write(example.SerializeToString())
+        save_atomic(os.path.join(self.path, self.shard_name(start, stop)), save)
+
+    def commit(self, block, payload):
+        pass
+
+    def close(self):
+        shards = [{'file': self.shard_name(start, stop), 'num_examples': stop - start,
+                   'bytes': os.path.getsize(os.path.join(self.path, self.shard_name(start, stop)))}
+                  for start, stop in self.blocks]
+        index = {'compression': self.compression, 'dtype': self.dtype.str, 'shape': list(self.shape),
+                 'shards': shards}
+        write_json(os.path.join(self.path, TFRECORD_INDEX), index)
+
+
+class Hdf5Target:
+    """Workers compress their blocks into HDF5 chunks, the main process appends them in order. A
+    volume is done once its name is in the file."""
+    ordered = True
+
+    def __init__(self, path, source, blocks, args):
+        super(Hdf5Target, self).__init__()
+        self.path = path
+        self.shape = tuple(source.shape)
+        self.dtype = np.dtype(source.dtype)
+        self.stems = source.stems
+        self.level = args.hdf5_level
+
+        written = set()
+        if os.path.isfile(path):
+            volumes = Hdf5Volumes(path)
+            written = set(volumes.files)
+            volumes.close()
+        self.done = set((start, stop) for start, stop in blocks
+                        if all(s + '.npy' in written for s in source.stems[start: stop]))
+        # Opened on first use, h5py handles must not be inherited by the forked workers.
+        self.writer = None
+
+    def __getstate__(self):
+        state = self.__dict__.copy()
+        state['writer'] = None
+        return state
+
+    def write_block(self, start, stop, stems, arrays):
+        return [compress_hdf5_chunk(array, self.level) for array in arrays]
+
+    def commit(self, block, payload):
+        if self.writer is None:
+            self.writer = Hdf5Writer(self.path, self.shape, self.dtype, level=self.level)
+        start, stop = block
+        for i, buf in zip(range(start, stop), payload):
+            self.writer.append_chunk(self.stems[i] + '.npy', buf)
+
+    def close(self):
+        if self.writer is not None:
+            self.writer.close()
+
+
+TARGETS = {
+    'npy': NpyTarget,
+    'pt': PtTarget,
+    'packed': PackedTarget,
+    'chunked': ChunkedTarget,
+    'tfrecord': TFRecordTarget,
+    'hdf5': Hdf5Target,
+}
+
+# Set in every worker of the pool by `init_worker`.
+source = None
+target = None
+
+
+def init_worker(source_args, worker_target):
+    global source, target
+    source = SOURCES[source_args[0]](*source_args[1:])
+    target = worker_target
+
+
+def convert_block(block):
+    start, stop = block
+    return block, target.write_block(start, stop, source.stems[start: stop], source.read(start, stop))
+
+
+def convert_phase(src_path, dst_path, size, metadata, args):
+    source_args = (args.src_format, src_path, size, metadata)
+    phase_source = SOURCES[args.src_format](*source_args[1:])
+    volume_bytes = int(np.prod(phase_source.shape)) * np.dtype(phase_source.dtype).itemsize
+    blocks = phase_source.blocks(max(1, args.block_mb * 2 ** 20 // volume_bytes))
+    phase_target = TARGETS[args.dst_format](dst_path, phase_source, blocks, args)
+
+    todo = [block for block in blocks if block not in phase_target.done]
+    print(f"{dst_path}: converting {sum(stop - start for start, stop in todo)} of {len(phase_source)} volumes "
+          f"of shape {tuple(phase_source.shape)} in {len(todo)} blocks")
+    # Every worker opens the source itself in `init_worker`; open h5py or file handles of the main
+    # process must not be inherited by the forked workers.
+    phase_source.close()
+
+    with Pool(args.num_workers, initializer=init_worker, initargs=(source_args, phase_target)) as pool:
+        imap = pool.imap if phase_target.ordered else pool.imap_unordered
+        for i, (block, payload) in enumerate(imap(convert_block, todo)):
+            phase_target.commit(block, payload)
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1} / {len(todo)} blocks")
+    phase_target.close()
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Convert a dataset of {size}x{size} phases between storage formats.")
+    parser.add_argument('src', type=str, help='Dataset directory containing the phases.')
+    parser.add_argument('dst', type=str)
+    parser.add_argument('--from', dest='src_format', default='npy', choices=FORMATS)
+    parser.add_argument('--to', dest='dst_format', required=True, choices=FORMATS)
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128, 256, 512])
+    parser.add_argument('--src_pattern', type=str, default='{size}x{size}',
+                        help='Name of a phase in src, e.g. tfrecords_{size}x{size}x{size} for old record directories.')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--block_mb', type=int, default=160,
+                        help='Uncompressed size of the blocks that are converted by one worker at a time.')
+    parser.add_argument('--chunk_depth', type=int, default=8, help='For --to chunked.')
+    parser.add_argument('--codec', default='zlib', choices=['zlib', 'blosc', 'zstd'], help='For --to chunked.')
+    parser.add_argument('--level', type=int, default=3, help='For --to chunked.')
+    parser.add_argument('--tfrecord_compression', default='GZIP', choices=['GZIP', 'ZLIB', 'none'])
+    parser.add_argument('--hdf5_level', type=int, default=4, help='gzip level of the hdf5 chunks, 0 to store them raw.')
+    args = parser.parse_args()
+
+    metadata = read_dataset_metadata(args.src)
+    if os.path.isfile(os.path.join(args.src, DATASET_METADATA)):
+        os.makedirs(args.dst, exist_ok=True)
+        shutil.copy(os.path.join(args.src, DATASET_METADATA), os.path.join(args.dst, DATASET_METADATA))
+
+    for size in args.sizes:
+        src_path = phase_path(args.src, args.src_format, args.src_pattern, size)
+        if not os.path.exists(src_path):
+            print(f"Skipping {src_path}, does not exist.")
+            continue
+        convert_phase(src_path, phase_path(args.dst, args.dst_format, '{size}x{size}', size), size, metadata, args)
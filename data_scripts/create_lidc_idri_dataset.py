@@ -6,11 +6,18 @@ import numpy as np
 import argparse
 from multiprocessing import Pool
 import matplotlib.pyplot as plt
-from skimage.measure import block_reduce
 import h5py
 import sys
+import json
+import glob
+import time
 from tqdm import tqdm
 
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SURFGAN_3D'))
+from storage import ChunkedWriter, Hdf5Writer, read_json, write_json, hdf5_path, compress_hdf5_chunk
+from pyramid import build_pyramid, REDUCTIONS
+from series_catalog import CATALOG, scan, accepted, load_catalog
+
 
 def get_dcm_paths(root):
     for (directory, subdirectories, files) in os.walk(root):
@@ -29,11 +36,6 @@ def read_dcm_series(path):
 
     return sitk_image
 
-def absmax(a, axis=None):
-    amax = a.max(axis)
-    amin = a.min(axis)
-    return np.where(-amin > amax, amin, amax)
-
 # https://dcm_pathsthub.com/SimpleITK/SlicerSimpleFilters/blob/master/SimpleFilters/SimpleFilters.py
 _SITK_INTERPOLATOR_DICT = {
     'nearest': sitk.sitkNearestNeighbor,
@@ -120,29 +122,7 @@ def resample_sitk_image(sitk_image, spacing=None, interpolator=None,
 
     return resampled_sitk_image, orig_spacing
 
-def L(x, a):
-    return np.sinc(x) * np.sinc(x / a)
-
-def lanczos_3d(x, axis, a=4):
-    
-    assert x.shape[-3] == x.shape[-2] == x.shape[-1]
-    # X-axis
-    filter_size = x.shape[-1]
-    d = filter_size / 2  # Location to interpolate on.
-    ds = np.arange(-d + 0.5, d - 0.5 + 1)  # Distances to consider.
-    l_in = ds * (a / d)  # Normalize to Lanczos a range.
-    f = L(l_in, a)
-    f = f[:, np.newaxis, np.newaxis] * f[np.newaxis, :, np.newaxis] * f[np.newaxis, np.newaxis, :]  # Make 3d
-    
-    f = f / f.sum()  # normalize
-    for _ in range(len(f.shape), len(x.shape)):
-        f = f[np.newaxis, ...]
-        
-    filtered = (f * x).sum(axis=axis)
-    
-    return filtered
-
-def read_resample_resize_dcm(path, reduce_fn):
+def read_resample_resize_dcm(path, reduce='average'):
 
     image = read_dcm_series(path)
 
@@ -203,80 +183,192 @@ def read_resample_resize_dcm(path, reduce_fn):
         resampled_array = np.pad(resampled_array, [(z_pad, 0), (0, 0), (0, 0)], mode='constant', constant_values=0)
     assert resampled_array.shape == (128, 512, 512), resampled_array.shape
     
-    resampled_arrays = [resampled_array.astype(np.uint16)]
-
-    for i in range(1, 8):
-        kernel = 2 ** i
-        reduced = block_reduce(resampled_array, (kernel, kernel, kernel), func=reduce_fn, cval=0)
-        reduced = np.clip(reduced, 0, clip_value - pad_value)
-        reduced = reduced.astype(np.uint16)
-        resampled_arrays.append(reduced)
+    # Every level is derived from the previous one with a separable filter, see SURFGAN_3D/pyramid.py.
+    resampled_arrays = [np.clip(level, 0, clip_value - pad_value).astype(np.uint16)
+                        for level in build_pyramid(resampled_array, 7, reduce=reduce)]
     metadata['intercept'] = abs(pad_value)
+    metadata['scale'] = abs(pad_value)
     metadata['data_shape'] = 'DHW'
 
     return resampled_arrays, metadata
 
 
-def get_dicom_iterator(root, reduce_fn):
+def get_dicom_iterator(root, reduce='average'):
     for path in get_dcm_paths(root):
         try:
-            array, metadata = read_resample_resize_dcm(path, reduce_fn=reduce_fn)
+            array, metadata = read_resample_resize_dcm(path, reduce=reduce)
         except RuntimeError as e:
             print("Continuing...")
             continue
         else:
             yield array, metadata
 
-average = np.average
-# reduce_fn = lanczos_3d
-# reduce_fn = absmax
-reduce_fn = average
-dataset_dir = f'/lustre4/2/managed_datasets/LIDC-IDRI'
-# hdf5_dir = os.path.join(dataset_dir, 'hdf5', reduce_fn.__name__)
-# 
-# if not os.path.exists(hdf5_dir):
-#     os.makedirs(hdf5_dir)
-    
-# hdf5_files = None
+def save_atomic(path, array):
+    # np.save appends .npy to names without it, so keep the suffix on the temporary file.
+    tmp_path = path[:-len('.npy')] + '.tmp.npy'
+    np.save(tmp_path, array)
+    os.replace(tmp_path, path)
 
-total = len(os.listdir(dataset_dir))
-num_iters = total
 
-for i, (arrays, metadata) in enumerate(tqdm(get_dicom_iterator(dataset_dir, reduce_fn))):
-    
-    
-    intercept = metadata['intercept']
-    
-    # if hdf5_files is None:
-        
-        # hdf5_files = {}
-        # intercept = np.array(metadata['intercept'])
-        # 
-        # for array in arrays:
-        #     size = array.shape[-1]
-        #     dataset_shape = [num_iters] + list(array.shape)
-        #     hdf5_file = h5py.File(os.path.join(hdf5_dir, f'{size}x{size}.h5'), mode='w')
-        #     hdf5_file.create_dataset('data', dataset_shape, np.uint16)
-        #     hdf5_file.create_dataset('intercept', [num_iters] + list(intercept.shape), np.int)
-        #     hdf5_files[f'{size}x{size}'] = hdf5_file
-    
-    for j, array in enumerate(arrays):
+def process_series(item, output_dir, reduce, stored_sizes, output_format='npy', hdf5_level=None):
+    """Reads, resamples and reduces one series and writes every stored level of its pyramid.
 
+    Each level is written to a temporary file and renamed, so a crashed run never leaves a
+    truncated volume behind. For the 'chunked' format nothing is written and the levels are
+    returned instead. For 'hdf5', the levels are returned as compressed HDF5 chunks, so the
+    compression runs in the pool and the writing process only stores the bytes.
+    """
+    series_id, path = item
+    try:
+        arrays, metadata = read_resample_resize_dcm(path, reduce=reduce)
+    except RuntimeError as e:
+        return {'id': series_id, 'path': path, 'status': 'skipped', 'error': str(e)}, None
+
+    arrays = [array for array in arrays if array.shape[-1] in stored_sizes]
+    if output_format == 'chunked':
+        return {'id': series_id, 'path': path, 'status': 'done'}, arrays
+    if output_format == 'hdf5':
+        chunks = [(array.shape, compress_hdf5_chunk(array, hdf5_level)) for array in arrays]
+        return {'id': series_id, 'path': path, 'status': 'done'}, chunks
+
+    for array in arrays:
         size = array.shape[-1]
-        # hdf5_files[f'{size}x{size}']['data'][i, ...] = array[None]
-        # hdf5_files[f'{size}x{size}']['intercept'][i, ...] = intercept
-        
-        # pt_dir = os.path.join(dataset_dir, 'pt', reduce_fn.__name__, f'{size}x{size}')
-        npy_dir = os.path.join(dataset_dir, 'npy', reduce_fn.__name__, f'{size}x{size}')
-        
-        # if not os.path.exists(pt_dir):
-        #     os.makedirs(pt_dir)
+        npy_dir = os.path.join(output_dir, f'{size}x{size}')
+        os.makedirs(npy_dir, exist_ok=True)
+        save_atomic(os.path.join(npy_dir, f'{series_id:04}.npy'), array)
+    return {'id': series_id, 'path': path, 'status': 'done'}, None
 
-        if not os.path.exists(npy_dir):
-            os.makedirs(npy_dir)
 
-        # torch.save(torch.from_numpy((array - intercept).astype(np.int16)), os.path.join(pt_dir, f'{i:04}.pt'))
-        np.save(os.path.join(npy_dir, f'{i:04}.npy'), array)
-        
-# for size in hdf5_files:
-#     hdf5_files[size].close()
+SERIES_IDS = 'series_ids.json'
+
+
+def assign_series_ids(paths, ids_path):
+    """Maps every series path to the id its volumes are written under, e.g. 0042.npy.
+
+    Ids in `ids_path` are kept, and series that are not in it get the next free ids in sorted
+    order. So adding series to the dataset never renumbers the existing ones, and every shard
+    that sees the same catalog computes the same map.
+    """
+    ids = read_json(ids_path) if os.path.isfile(ids_path) else {}
+    next_id = max(ids.values(), default=-1) + 1
+    for path in sorted(paths):
+        if path not in ids:
+            ids[path] = next_id
+            next_id += 1
+    write_json(ids_path, ids)
+    return ids
+
+
+def wait_for_series_ids(catalog_path, ids_path, max_interval=30):
+    """Loads the catalog and the id map written by shard 0, waiting until the map covers every
+    series in the catalog."""
+    interval = 1
+    while True:
+        if os.path.isfile(catalog_path) and os.path.isfile(ids_path):
+            catalog = load_catalog(catalog_path)
+            ids = read_json(ids_path)
+            if all(str(path) in ids for path in catalog['path']):
+                return catalog, ids
+        time.sleep(interval)
+        interval = min(2 * interval, max_interval)
+
+
+def read_manifests(output_dir):
+    """The series paths that any shard has finished, successfully or not."""
+    finished = set()
+    for manifest in glob.glob(os.path.join(output_dir, 'manifest-*.jsonl')):
+        with open(manifest) as f:
+            for line in f:
+                try:
+                    finished.add(json.loads(line)['path'])
+                except json.JSONDecodeError:
+                    # The last line of an interrupted run may be incomplete.
+                    continue
+    return finished
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Preprocess the LIDC-IDRI DICOM series into a pyramid of "
+                                                 "uint16 volumes per resolution.")
+    parser.add_argument('--dataset_dir', type=str, default='/lustre4/2/managed_datasets/LIDC-IDRI')
+    parser.add_argument('--output_dir', type=str, default=None, help='Defaults to dataset_dir.')
+    parser.add_argument('--reduce', default='average', choices=REDUCTIONS)
+    # 'npy' writes one file per volume, 'chunked' and 'hdf5' one store per resolution (see SURFGAN_3D/storage.py).
+    parser.add_argument('--output_format', default='npy', choices=['npy', 'chunked', 'hdf5'],
+                        help="'chunked' and 'hdf5' are written by a single job, 'chunked' cannot be resumed.")
+    parser.add_argument('--hdf5_level', type=int, default=4, help='gzip level of the hdf5 chunks, 0 to store them raw.')
+    # Levels left out here can be computed on the fly by the 3D trainer with --pyramid.
+    parser.add_argument('--stored_sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128, 256, 512])
+    parser.add_argument('--num_workers', type=int, default=os.cpu_count())
+    parser.add_argument('--num_shards', type=int, default=1, help='Split the series over this many jobs.')
+    parser.add_argument('--shard_index', type=int, default=0)
+    parser.add_argument('--catalog', type=str, default=None,
+                        help=f'Header catalog of the series (see series_catalog.py), defaults to dataset_dir/{CATALOG}.')
+    args = parser.parse_args()
+
+    if args.output_format in ('chunked', 'hdf5') and args.num_shards > 1:
+        raise ValueError(f"The {args.output_format} format is written by a single job, use --num_shards 1.")
+
+    output_dir = os.path.join(args.output_dir or args.dataset_dir, args.output_format, args.reduce)
+    os.makedirs(output_dir, exist_ok=True)
+
+    catalog_path = args.catalog or os.path.join(args.dataset_dir, CATALOG)
+    ids_path = os.path.join(output_dir, SERIES_IDS)
+    if args.shard_index == 0:
+        # Read by the 3D trainer to map the stored uint16 values to the training range.
+        write_json(os.path.join(output_dir, 'metadata.json'), {'intercept': 1024, 'scale': 1024, 'dtype': 'uint16'})
+
+        # Only the DICOM headers are read to drop series that would be rejected anyway, the catalog is
+        # reused by later runs. Ids are persisted next to the output, so they do not depend on the
+        # sharding, on which series were processed before an interruption, or on series added later.
+        catalog = scan(args.dataset_dir, catalog_path, args.num_workers)
+        ids = assign_series_ids([str(path) for path in catalog['path']], ids_path)
+    else:
+        # Shard 0 is the only writer of the catalog and the ids; the other shards read them. If they
+        # start before shard 0 has rescanned, they miss new series this run and pick them up on resume.
+        catalog, ids = wait_for_series_ids(catalog_path, ids_path)
+    mask = accepted(catalog)
+    print(f"{mask.sum()} of {len(mask)} series pass the header checks.")
+
+    # Sharding by id keeps every series in the same shard, whichever version of the catalog a shard read.
+    series = sorted((ids[str(path)], str(path)) for i, path in enumerate(catalog['path']) if mask[i])
+    shard = [item for item in series if item[0] % args.num_shards == args.shard_index]
+
+    if args.output_format in ('npy', 'hdf5'):
+        finished = read_manifests(output_dir)
+        todo = [item for item in shard if item[1] not in finished]
+    else:
+        todo = shard
+    print(f"Shard {args.shard_index}/{args.num_shards}: {len(todo)} of {len(shard)} series left to process.")
+
+    writers = {}
+    manifest_path = os.path.join(output_dir, f'manifest-{args.shard_index:03}-of-{args.num_shards:03}.jsonl')
+    process = partial(process_series, output_dir=output_dir, reduce=args.reduce,
+                      stored_sizes=set(args.stored_sizes), output_format=args.output_format, hdf5_level=args.hdf5_level)
+
+    with open(manifest_path, 'a') as manifest, Pool(args.num_workers) as pool:
+        for entry, arrays in tqdm(pool.imap_unordered(process, todo), total=len(todo)):
+            if entry['status'] != 'done':
+                print(f"Skipping {entry['path']}: {entry['error']}")
+
+            if args.output_format == 'chunked' and arrays is not None:
+                for array in arrays:
+                    size = array.shape[-1]
+                    if size not in writers:
+                        writers[size] = ChunkedWriter(os.path.join(output_dir, f'{size}x{size}'))
+                    writers[size].append(f"{entry['id']:04}.npy", array)
+            elif args.output_format == 'hdf5' and arrays is not None:
+                for shape, buf in arrays:
+                    size = shape[-1]
+                    if size not in writers:
+                        # Reopening an existing file resumes it, volumes already in it are skipped.
+                        writers[size] = Hdf5Writer(hdf5_path(os.path.join(output_dir, f'{size}x{size}')), shape,
+                                                   np.uint16, level=args.hdf5_level)
+                    writers[size].append_chunk(f"{entry['id']:04}.npy", buf)
+
+            # A series is only marked as finished once all of its levels are on disk.
+            manifest.write(json.dumps(entry) + '\n')
+            manifest.flush()
+
+    for size in writers:
+        writers[size].close()
@@ -1,20 +1,17 @@
-import tensorflow as tf
-import os
-from functools import partial
-import SimpleITK as sitk
-import numpy as np
-import skimage
+"""Builds the metadata catalog of a DICOM dataset: per series size, spacing, origin, direction
+(read from the headers, see series_catalog.py) and HU min/max. Updates are incremental, only new
+or changed series are read."""
 import argparse
-from skimage.measure import block_reduce
-import pandas as pd
+import os
 from multiprocessing import Pool
-import time
+import numpy as np
+import SimpleITK as sitk
+from series_catalog import CATALOG, COLUMNS, scan, save_catalog, accepted
 
-def get_dcm_paths(root):
-    for i, (directory, subdirectories, files) in enumerate(os.walk(root)):
-        print(i)
-        if any(path.endswith('.dcm') for path in os.listdir(directory)):
-            yield directory
+try:
+    import pandas as pd
+except ImportError:
+    pd = None
 
 
 def read_dcm_series(path):
@@ -28,43 +25,61 @@ def read_dcm_series(path):
     
     return sitk_image
 
-#### Get statistics
 
-root = '/project/davidr/lidc_idri/'
+def hu_range(path):
+    try:
+        array = sitk.GetArrayViewFromImage(read_dcm_series(path))
+        return path, float(array.min()), float(array.max())
+    except RuntimeError:
+        return path, np.nan, np.nan
 
-def track_job(job, update_interval=3):
-    while job._number_left > 0:
-        print("Tasks remaining = {0}".format(
-        job._number_left * job._chunksize))
-        time.sleep(update_interval)
 
+def update_hu_range(columns, num_workers=None, only_accepted=True):
+    """Fills in the HU min/max of the series that do not have them yet, in a process pool."""
+    todo = np.isnan(columns['hu_min']) & (columns['error'] == '')
+    if only_accepted:
+        todo &= accepted(columns)
+    paths = [str(p) for p in columns['path'][todo]]
+    print(f"Reading pixel data of {len(paths)} series.")
 
+    row = {str(p): i for i, p in enumerate(columns['path'])}
+    with Pool(num_workers) as pool:
+        for i, (path, hu_min, hu_max) in enumerate(pool.imap_unordered(hu_range, paths, chunksize=4)):
+            columns['hu_min'][row[path]] = hu_min
+            columns['hu_max'][row[path]] = hu_max
+            if (i + 1) % 100 == 0:
+                print(f"{i + 1} / {len(paths)}")
+    return columns
 
-def map_fn(path):
-    image = read_dcm_series(path)    
-    metadata = {}
-    
-    metadata['path'] = path
-    metadata['orig_depth'] = image.GetDepth()
-    metadata['orig_spacing'] = tuple(image.GetSpacing())
-    metadata['orig_origin'] = tuple(image.GetOrigin())
-    metadata['orig_direction'] = tuple(image.GetDirection())
-    metadata['orig_size'] = tuple(image.GetSize())
-     
-    array = sitk.GetArrayFromImage(image)
-    metadata['orig_min'] = array.min()
-    metadata['orig_max'] = array.max()
-    
-    metadata['orig_mean'] = array.mean()
-    metadata['orig_std'] = array.std()
-    metadata['orig_median'] = np.median(array)
-    
-    return metadata
 
-p = Pool()
-res = p.map_async(map_fn, get_dcm_paths(root))
-track_job(res)
+def to_parquet(columns, path):
+    # Multi-valued columns become one column per component, e.g. spacing_0, spacing_1, spacing_2.
+    frame = {}
+    for name, (_, width) in COLUMNS.items():
+        if width is None:
+            frame[name] = columns[name]
+        else:
+            for j in range(width):
+                frame[f'{name}_{j}'] = columns[name][:, j]
+    pd.DataFrame(frame).to_parquet(path, index=False)
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Build or update the metadata catalog of a DICOM dataset.")
+    parser.add_argument('dataset_dir', type=str)
+    parser.add_argument('--catalog', type=str, default=None, help=f'Defaults to dataset_dir/{CATALOG}.')
+    parser.add_argument('--num_workers', type=int, default=None)
+    parser.add_argument('--all_series', default=False, action='store_true',
+                        help='Also compute HU min/max of series that the preprocessing rejects.')
+    parser.add_argument('--parquet', type=str, default=None, help='Also write the catalog to this Parquet file.')
+    args = parser.parse_args()
+
+    catalog_path = args.catalog or os.path.join(args.dataset_dir, CATALOG)
+    columns = scan(args.dataset_dir, catalog_path, args.num_workers)
+    columns = update_hu_range(columns, args.num_workers, only_accepted=not args.all_series)
+    save_catalog(catalog_path, columns)
 
-metadatas = res.get()
-metadata_df = pd.DataFrame(metadatas)
-metadata_df.to_csv('metadata.csv', index=None)
\ No newline at end of file
+    if args.parquet:
+        if pd is None:
+            raise ImportError("Writing Parquet requires pandas and pyarrow.")
+        to_parquet(columns, args.parquet)
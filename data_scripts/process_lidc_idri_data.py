@@ -5,8 +5,13 @@ import SimpleITK as sitk
 import numpy as np
 import skimage
 import argparse
-from skimage.measure import block_reduce
 from multiprocessing import Pool
+import sys
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SURFGAN_3D'))
+from pyramid import build_pyramid
+from storage import write_json, DATASET_METADATA, TFRECORD_INDEX
+from series_catalog import accepted_series
 
 def get_dcm_paths(root):
     for (directory, subdirectories, files) in os.walk(root):
@@ -118,24 +123,6 @@ def resample_sitk_image(sitk_image, spacing=None, interpolator=None,
     return resampled_sitk_image, orig_spacing
 
 
-def L(x, a):
-    return np.sinc(x) * np.sinc(x / a)
-
-def lanczos_3d(x, axis, a=4):
-    assert x.shape[3] == x.shape[-2] == x.shape[-1], "Cuboid filter not implemented yet."
-    filter_size = x.shape[-1]
-    d = filter_size / 2  # Location to interpolate on.
-    ds = np.arange(-d + 0.5, d - 0.5 + 1)  # Distances to consider.
-    l_in = ds * (a / d)  # Normalize to Lanczos a range.
-    f = L(l_in, a)  # 1D filter
-    f = f[:, np.newaxis, np.newaxis] * f[np.newaxis, :, np.newaxis] * f[np.newaxis, np.newaxis, :]  # Make 3d
-    f = f / f.sum()  # normalize
-    for _ in range(len(f.shape), len(x.shape)):
-        f = f[np.newaxis, ...]
-    
-    return (f * x).sum(axis=axis)
-
-
 def read_resample_resize_dcm(path):
 
     image = read_dcm_series(path)
@@ -197,12 +184,10 @@ def read_resample_resize_dcm(path):
     metadata['resampled_min'] = resampled_array.min()
     metadata['resampled_max'] = resampled_array.max()
 
-    resampled_arrays = [resampled_array]
     print(resampled_array.shape, resampled_array.min(), resampled_array.max())
-    
-    for i in range(1, 8):
-        kernel = 2 ** i
-        resampled_arrays.append(block_reduce(resampled_array, (kernel, kernel, kernel), func=lanczos_3d, cval=pad_value / abs(pad_value)))
+
+    # Every level is derived from the previous one with a separable Lanczos filter.
+    resampled_arrays = build_pyramid(resampled_array, 7, reduce='lanczos')
     metadata['normalization_constant'] = abs(pad_value)
     metadata['data_shape'] = 'DHW'
 
@@ -210,7 +195,7 @@ def read_resample_resize_dcm(path):
 
 
 def get_dicom_iterator(root):
-    for path in get_dcm_paths(root):
+    for path in accepted_series(root):
         try:
             array, metadata = read_resample_resize_dcm(path)
         except RuntimeError as e:
@@ -220,248 +205,134 @@ def get_dicom_iterator(root):
         else:
             yield array, metadata
 
-def _bytes_feature(value):
-    """Returns a bytes_list from a string / byte."""
-    return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
-
-def _float_feature(value):
-    """Returns a float_list from a float / double."""
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
-
-def _int64_feature(value):
-    """Returns an int64_list from a bool / enum / int / uint."""
-    return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
-
-
-def to_tfrecords(tensor_metadata, counter, output_dir):
-    # write records to a tfrecords file
-    writer = tf.io.TFRecordWriter(os.path.join(output_dir, f'{counter:04}.tfrecord'))
-
-    tensor = tensor_metadata[0]
-    metadata = tensor_metadata[1]
-
-    # Loop through all the features you want to write
-    features = {}
-    features['image'] = tf.train.Feature(float_list=tf.train.FloatList(value=tensor.numpy().flatten()))
-    for k in metadata:
-        value = metadata[k].numpy()
-
-        if metadata[k].dtype == tf.string:
-            feature = _bytes_feature(value)
-        elif metadata[k].dtype == tf.float32:
-            feature = _float_feature(value.flatten())
-
-        elif metadata[k].dtype == tf.int16:
-            feature = _int64_feature(value.flatten())
-        else:
-            raise NotImplementedError(f"Unsupported dtype {metadata[k].dtype}")
-
-        features[k] = feature
-
-    # Construct the Example proto object
-    example = tf.train.Example(features=tf.train.Features(feature=features))
-
-    # Serialize the example to a string
-    serialized = example.SerializeToString()
-
-    # write the serialized objec to the disk
-    writer.write(serialized)
-    writer.close()
-
-
-dataset_dir = '/project/davidr/lidc_idri/'
-size = 64
-# size = args.image_size
-
-array_output_type = tf.float32
-array_output_shape = (size, size, size)
-
-metadata_output_types = {'path': tf.string,
-                          'orig_depth': tf.int16,
-                          'orig_spacing': tf.float32,
-                          'orig_origin': tf.float32,
-                          'orig_direction': tf.float32,
-                          'orig_size': tf.int16,
-                          'orig_min': tf.float32,
-                          'orig_max': tf.float32,
-                          'resampled_depth': tf.int16,
-                          'resampled_spacing': tf.float32,
-                          'resampled_origin': tf.float32,
-                          'resampled_direction': tf.float32,
-                          'resampled_size': tf.float32,
-                          'resampled_min': tf.float32,
-                          'resampled_max': tf.float32,
-                          'normalization_constant': tf.int16,
-                          'data_shape': tf.string
-                         }
-
-metadata_output_shapes = {
-      'path': (),
-      'orig_depth': (),
-      'orig_spacing': (3,),
-      'orig_origin': (3,),
-      'orig_direction': (9,),
-      'orig_size': (3,),
-      'orig_min': (),
-      'orig_max': (),
-      'resampled_depth': (),
-      'resampled_spacing': (3,),
-      'resampled_origin': (3,),
-      'resampled_direction': (9,),
-      'resampled_size': (3,),
-      'resampled_min': (),
-      'resampled_max': (),
-      'normalization_constant': (),
-      'data_shape': ()
-}
-
-
-# dicom_dataset = tf.data.Dataset.from_generator(partial(get_dicom_iterator, root=dataset_dir, size=size),
-#                                                output_types=(array_output_type, metadata_output_types),
-#                                                output_shapes=(array_output_shape, metadata_output_shapes))
-
-# for i, (arrays, metadata) in enumerate(get_dicom_iterator(dataset_dir)):
-    
-
-#     for k in metadata:
-#         print(k)
-#         metadata[k] = tf.constant(metadata[k], shape=metadata_output_shapes[k], dtype=metadata_output_types[k])
-#         metadata[k].numpy()
-      
-#     for array in arrays:
-#         size = array.shape[-1]
-#         output_dir = os.path.join(dataset_dir, f'tfrecords_new_{size}x{size}')
-#         if not os.path.exists(output_dir):
-#             os.makedirs(output_dir, exist_ok=True)
-
-#         tensor = tf.constant(array, dtype=tf.float32)
-#         to_tfrecords((tensor, metadata), i, output_dir)
-
-
-def get_dicom_iterator(root):
-    for path in get_dcm_paths(root):
-        try:
-            array, metadata = read_resample_resize_dcm(path)
-        except RuntimeError as e:
-            print(e)
-            print("Continuing...")
-            continue
-        else:
-            yield array, metadata
 
 def _bytes_feature(value):
     """Returns a bytes_list from a string / byte."""
     return tf.train.Feature(bytes_list=tf.train.BytesList(value=[value]))
 
-def _float_feature(value):
-    """Returns a float_list from a float / double."""
-    return tf.train.Feature(float_list=tf.train.FloatList(value=value))
 
 def _int64_feature(value):
     """Returns an int64_list from a bool / enum / int / uint."""
     return tf.train.Feature(int64_list=tf.train.Int64List(value=value))
 
 
-def to_tfrecords(tensor_metadata, counter, output_dir):
-    # write records to a tfrecords file
-    writer = tf.io.TFRecordWriter(os.path.join(output_dir, f'{counter:04}.tfrecord'))
-
-    tensor = tensor_metadata[0]
-    metadata = tensor_metadata[1]
-
-    # Loop through all the features you want to write
-    features = {}
-    features['image'] = tf.train.Feature(float_list=tf.train.FloatList(value=tensor.numpy().flatten()))
-    for k in metadata:
-        value = metadata[k].numpy()
-
-        if metadata[k].dtype == tf.string:
-            feature = _bytes_feature(value)
-        elif metadata[k].dtype == tf.float32:
-            feature = _float_feature(value.flatten())
-
-        elif metadata[k].dtype == tf.int16:
-            feature = _int64_feature(value.flatten())
-        else:
-            raise NotImplementedError(f"Unsupported dtype {metadata[k].dtype}")
-
-        features[k] = feature
-
-    # Construct the Example proto object
-    example = tf.train.Example(features=tf.train.Features(feature=features))
-
-    # Serialize the example to a string
-    serialized = example.SerializeToString()
-
-    # write the serialized objec to the disk
-    writer.write(serialized)
-    writer.close()
-
-
-dataset_dir = '/project/davidr/lidc_idri/'
-
-array_output_type = tf.float32
-
-metadata_output_types = {'path': tf.string,
-                          'orig_depth': tf.int16,
-                          'orig_spacing': tf.float32,
-                          'orig_origin': tf.float32,
-                          'orig_direction': tf.float32,
-                          'orig_size': tf.int16,
-                          'orig_min': tf.float32,
-                          'orig_max': tf.float32,
-                          'resampled_depth': tf.int16,
-                          'resampled_spacing': tf.float32,
-                          'resampled_origin': tf.float32,
-                          'resampled_direction': tf.float32,
-                          'resampled_size': tf.float32,
-                          'resampled_min': tf.float32,
-                          'resampled_max': tf.float32,
-                          'normalization_constant': tf.int16,
-                          'data_shape': tf.string
-                         }
-
-metadata_output_shapes = {
-      'path': (),
-      'orig_depth': (),
-      'orig_spacing': (3,),
-      'orig_origin': (3,),
-      'orig_direction': (9,),
-      'orig_size': (3,),
-      'orig_min': (),
-      'orig_max': (),
-      'resampled_depth': (),
-      'resampled_spacing': (3,),
-      'resampled_origin': (3,),
-      'resampled_direction': (9,),
-      'resampled_size': (3,),
-      'resampled_min': (),
-      'resampled_max': (),
-      'normalization_constant': (),
-      'data_shape': ()
-}
-
-
-
-def apply_fn(arrays, metadata, i):
-    for k in metadata:
-        metadata[k] = tf.constant(metadata[k], shape=metadata_output_shapes[k], dtype=metadata_output_types[k])
-      
-    for array in arrays:
-        size = array.shape[-1]
-        output_dir = os.path.join(dataset_dir, f'tfrecords_new_lanczos_{size}x{size}')
-        if not os.path.exists(output_dir):
-            os.makedirs(output_dir)
-
-        tensor = tf.constant(array, dtype=tf.float32)
-        to_tfrecords((tensor, metadata), i, output_dir)
-
-
-# p = Pool()
-total = len(os.listdir(dataset_dir))
-for i, (arrays, metadata) in enumerate(get_dicom_iterator(dataset_dir)):
-    # p.apply_async(apply_fn, args=data)
-# p.map_async(apply_fn, get_dicom_iterator(dataset_dir))
-    apply_fn(arrays, metadata, i)
-
-    print(f"{i} / {total}")
+class ShardedTFRecordWriter:
+    """Writes volumes as raw bytes into TFRecord shards of about `shard_bytes` each and, on
+    `close`, an index of the shards that SURFGAN_3D's TFRecordDataset reads.
+
+    The on-disk size of a shard is only measured every `stat_every` records (flushing the
+    compressor more often hurts the GZIP ratio); in between it is estimated from the
+    serialized bytes written and the last compression ratio seen, carried across shards."""
+    def __init__(self, output_dir, shard_bytes=160 * 2 ** 20, compression='GZIP', stat_every=64):
+        super(ShardedTFRecordWriter, self).__init__()
+        os.makedirs(output_dir, exist_ok=True)
+        self.output_dir = output_dir
+        self.shard_bytes = shard_bytes
+        self.stat_every = stat_every
+        self.compression = compression if compression != 'none' else ''
+        self.options = tf.io.TFRecordOptions(self.compression or None)
+        self.index = {'compression': self.compression, 'dtype': None, 'shape': None, 'shards': []}
+        self.writer = None
+        self.ratio = 1.
+
+    def _open_shard(self):
+        shard = {'file': f"{len(self.index['shards']):05}.tfrecord", 'num_examples': 0, 'bytes': 0}
+        self.index['shards'].append(shard)
+        self.writer = tf.io.TFRecordWriter(os.path.join(self.output_dir, shard['file']), self.options)
+        # Serialized bytes written, and the serialized / on-disk bytes at the last measurement.
+        self.serialized_bytes = 0
+        self.measured = (0, 0)
+
+    def _close_shard(self):
+        self.writer.close()
+        self.writer = None
+        shard = self.index['shards'][-1]
+        shard['bytes'] = os.path.getsize(os.path.join(self.output_dir, shard['file']))
+        if self.serialized_bytes:
+            self.ratio = shard['bytes'] / self.serialized_bytes
+
+    def write(self, name, array):
+        if self.index['shape'] is None:
+            self.index['shape'] = list(array.shape)
+            self.index['dtype'] = array.dtype.str
+        assert list(array.shape) == self.index['shape'], "All volumes must have the same shape."
+        assert array.dtype.str == self.index['dtype'], "All volumes must have the same dtype."
+
+        if self.writer is None:
+            self._open_shard()
+
+        example = tf.train.Example(features=tf.train.Features(feature={
+            'image': _bytes_feature(np.ascontiguousarray(array).tobytes()),
+            'shape': _int64_feature(array.shape),
+            'path': _bytes_feature(name.encode()),
+        }))
+        serialized = example.SerializeToString()
+        self.writer.write(serialized)
+        self.serialized_bytes += len(serialized)
+
+        shard = self.index['shards'][-1]
+        shard['num_examples'] += 1
+        if shard['num_examples'] % self.stat_every == 0:
+            self.writer.flush()
+            self.measured = (self.serialized_bytes,
+                             os.path.getsize(os.path.join(self.output_dir, shard['file'])))
+            self.ratio = self.measured[1] / self.measured[0]
+
+        measured_serialized, measured_bytes = self.measured
+        estimate = measured_bytes + (self.serialized_bytes - measured_serialized) * self.ratio
+        if estimate >= self.shard_bytes:
+            self._close_shard()
+
+    def close(self):
+        if self.writer is not None:
+            self._close_shard()
+        write_json(os.path.join(self.output_dir, TFRECORD_INDEX), self.index)
+        return self.index
+
+
+def to_uint16(array, normalization_constant=1024):
+    # Back from the normalized range to the HU + 1024 convention of the npy datasets.
+    return np.clip(np.round(array * normalization_constant + normalization_constant), 0, 3072).astype(np.uint16)
+
+
+def process_series(path):
+    try:
+        arrays, metadata = read_resample_resize_dcm(path)
+    except RuntimeError as e:
+        print(f"{path}: {e}")
+        return path, None
+    return path, [to_uint16(array, metadata['normalization_constant']) for array in arrays]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Write the LIDC-IDRI pyramid to sharded TFRecord files.")
+    parser.add_argument('--dataset_dir', type=str, default='/project/davidr/lidc_idri/')
+    parser.add_argument('--output_dir', type=str, default=None, help='Defaults to dataset_dir/tfrecords/lanczos.')
+    parser.add_argument('--compression', default='GZIP', choices=['GZIP', 'ZLIB', 'none'])
+    parser.add_argument('--shard_mb', type=int, default=160, help='Target size of a shard on disk.')
+    parser.add_argument('--sizes', type=int, nargs='+', default=[4, 8, 16, 32, 64, 128, 256, 512])
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    output_dir = args.output_dir or os.path.join(args.dataset_dir, 'tfrecords', 'lanczos')
+    os.makedirs(output_dir, exist_ok=True)
+    write_json(os.path.join(output_dir, DATASET_METADATA), {'intercept': 1024, 'scale': 1024, 'dtype': 'uint16'})
+
+    writers = {size: ShardedTFRecordWriter(os.path.join(output_dir, f'{size}x{size}'),
+                                           shard_bytes=args.shard_mb * 2 ** 20, compression=args.compression)
+               for size in args.sizes}
+
+    paths = accepted_series(args.dataset_dir)
+    with Pool(args.num_workers) as pool:
+        for i, (path, arrays) in enumerate(pool.imap(process_series, paths)):
+            print(f"{i} / {len(paths)}")
+            if arrays is None:
+                continue
+            for array in arrays:
+                size = array.shape[-1]
+                if size in writers:
+                    writers[size].write(path, array)
+
+    for size in writers:
+        index = writers[size].close()
+        print(f"{size}x{size}: {len(index['shards'])} shards")
@@ -0,0 +1,151 @@
+"""Header-only scan of the DICOM series in a dataset, stored as a columnar catalog.
+
+Only the DICOM headers are read, so the scan costs a fraction of a pixel decode. Series that do
+not match the preprocessing requirements can then be dropped before any pixel data is read.
+"""
+import argparse
+import os
+import socket
+from multiprocessing import Pool
+import numpy as np
+import SimpleITK as sitk
+
+CATALOG = 'series_catalog.npz'
+IDENTITY = (1.0, 0.0, 0.0, 0.0, 1.0, 0.0, 0.0, 0.0, 1.0)
+
+# Column name -> (dtype, width). Columns with a width hold one row of that many values per series.
+COLUMNS = {
+    'path': (str, None),
+    'mtime': (np.float64, None),
+    'size': (np.int64, 3),
+    'spacing': (np.float64, 3),
+    'origin': (np.float64, 3),
+    'direction': (np.float64, 9),
+    'error': (str, None),
+    # Filled in by extract_metadata.py, which has to read the pixel data.
+    'hu_min': (np.float64, None),
+    'hu_max': (np.float64, None),
+}
+
+
+def find_series(root):
+    """Sorted list of all directories under `root` that contain .dcm files."""
+    series = []
+    for directory, _, files in os.walk(root):
+        if any(f.endswith('.dcm') for f in files):
+            series.append(directory)
+    return sorted(series)
+
+
+def read_header(path):
+    reader = sitk.ImageFileReader()
+    reader.SetFileName(path)
+    reader.ReadImageInformation()
+    return reader
+
+
+def read_series_header(path):
+    """Size, spacing, origin and direction of a series, as `sitk.ImageSeriesReader` would report
+    them, without decoding pixel data. The slice spacing follows from the positions of the first
+    and last slice."""
+    row = {'path': path, 'mtime': os.stat(path).st_mtime, 'error': ''}
+    try:
+        # Sorts the slices by position, reading only their headers.
+        names = sitk.ImageSeriesReader.GetGDCMSeriesFileNames(path)
+        first = read_header(names[0])
+        size, spacing, origin = first.GetSize(), first.GetSpacing(), first.GetOrigin()
+
+        if len(names) > 1:
+            last = read_header(names[-1])
+            z_spacing = np.linalg.norm(np.subtract(last.GetOrigin(), origin)) / (len(names) - 1)
+        else:
+            z_spacing = spacing[2]
+
+        row['size'] = (size[0], size[1], len(names))
+        row['spacing'] = (spacing[0], spacing[1], z_spacing)
+        row['origin'] = origin
+        row['direction'] = first.GetDirection()
+    except (RuntimeError, IndexError) as e:
+        row['error'] = str(e) or type(e).__name__
+    return row
+
+
+def to_columns(rows):
+    columns = {}
+    for name, (dtype, width) in COLUMNS.items():
+        if width is None:
+            columns[name] = np.array([row.get(name, '' if dtype is str else np.nan) for row in rows], dtype=dtype)
+        else:
+            fill = np.zeros(width) if dtype is np.int64 else np.full(width, np.nan)
+            columns[name] = np.array([row.get(name, fill) for row in rows], dtype=dtype).reshape(-1, width)
+    return columns
+
+
+def to_rows(columns):
+    return [{name: columns[name][i] for name in columns} for i in range(len(columns['path']))]
+
+
+def load_catalog(catalog_path):
+    with np.load(catalog_path) as f:
+        return {name: f[name] for name in f.files}
+
+
+def save_catalog(catalog_path, columns):
+    # np.savez appends .npz to names without it, so keep the suffix on the temporary file. The name is
+    # unique per process, so concurrent writers do not replace each other's temporary file.
+    tmp_path = f"{catalog_path[:-len('.npz')]}.{socket.gethostname()}.{os.getpid()}.tmp.npz"
+    np.savez(tmp_path, **columns)
+    os.replace(tmp_path, catalog_path)
+
+
+def scan(root, catalog_path, num_workers=None):
+    """Reads the headers of every series under `root` in a process pool and saves the catalog.
+
+    Series that are already in the catalog at `catalog_path` with an unchanged directory mtime
+    are not read again.
+    """
+    previous = {}
+    if os.path.isfile(catalog_path):
+        previous = {row['path']: row for row in to_rows(load_catalog(catalog_path))}
+
+    paths = find_series(root)
+    todo = [p for p in paths if p not in previous or previous[p]['mtime'] != os.stat(p).st_mtime]
+    print(f"Reading headers of {len(todo)} of {len(paths)} series.")
+
+    with Pool(num_workers) as pool:
+        scanned = {row['path']: row for row in pool.imap_unordered(read_series_header, todo, chunksize=8)}
+
+    columns = to_columns([scanned[p] if p in scanned else previous[p] for p in paths])
+    save_catalog(catalog_path, columns)
+    return columns
+
+
+def accepted(columns, size=512, max_z_spacing=3, z_spacing=3, max_depth=160):
+    """Boolean mask of the series that pass the checks of
+    `create_lidc_idri_dataset.read_resample_resize_dcm`. Resampling the slices to `z_spacing`
+    must leave at most `max_depth` slices."""
+    resampled_depth = np.ceil(columns['size'][:, 2] * columns['spacing'][:, 2] / z_spacing)
+    return ((columns['error'] == '')
+            & (columns['size'][:, 0] == size)
+            & (columns['spacing'][:, 2] <= max_z_spacing)
+            & np.all(columns['direction'] == IDENTITY, axis=1)
+            & (resampled_depth <= max_depth))
+
+
+def accepted_series(root, catalog_path=None, num_workers=None):
+    """Sorted paths of the series under `root` that pass the preprocessing checks, taken from the
+    catalog if there is one, so no DICOM file is opened again."""
+    catalog_path = catalog_path or os.path.join(root, CATALOG)
+    columns = load_catalog(catalog_path) if os.path.isfile(catalog_path) else scan(root, catalog_path, num_workers)
+    return [str(p) for p in columns['path'][accepted(columns)]]
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description="Scan the DICOM headers of a dataset into a series catalog.")
+    parser.add_argument('dataset_dir', type=str)
+    parser.add_argument('--catalog', type=str, default=None, help=f'Defaults to dataset_dir/{CATALOG}.')
+    parser.add_argument('--num_workers', type=int, default=None)
+    args = parser.parse_args()
+
+    columns = scan(args.dataset_dir, args.catalog or os.path.join(args.dataset_dir, CATALOG), args.num_workers)
+    print(f"{accepted(columns).sum()} of {len(columns['path'])} series pass the preprocessing checks.")
@@ -1,5 +1,9 @@
 from torchvision.datasets import VisionDataset
+from torch.utils.data import Dataset
+import numpy as np
+import torch
 import os
+import warnings
 
 
 def has_file_allowed_extension(filename, extensions):
@@ -86,4 +90,53 @@ class DatasetFolder(VisionDataset):
         return sample
 
     def __len__(self):
-        return len(self.samples)
\ No newline at end of file
+        return len(self.samples)
+
+
+class VolumeDataset(Dataset):
+    """Memory-mapped .npy volumes, returned without conversion as (1, D, H, W) tensors.
+
+    Normalization to float is left to the training step, where it runs on the GPU. Samples are
+    views on the memory maps, so a volume is only copied when the loader collates the batch. The
+    dataset holds no lambdas or open memory maps when pickled, so it works with spawn-based workers.
+    Args:
+        root (string): Root directory path.
+        extensions (tuple[string]): A list of allowed extensions.
+    """
+
+    def __init__(self, root, extensions=('.npy',)):
+        super(VolumeDataset, self).__init__()
+        self.root = root
+        self.samples = make_dataset(root, extensions)
+        if len(self.samples) == 0:
+            raise (RuntimeError("Found 0 files in subfolders in: " + root + "\n"
+                                "Supported extensions are: " + ",".join(extensions)))
+        self._arrays = {}
+
+    def __getstate__(self):
+        # Every worker maps the files itself.
+        state = self.__dict__.copy()
+        state['_arrays'] = {}
+        return state
+
+    def _open(self, index):
+        array = self._arrays.get(index)
+        if array is None:
+            array = np.load(self.samples[index], mmap_mode='r')
+            self._arrays[index] = array
+        return array
+
+    def __getitem__(self, index):
+        array = np.asarray(self._open(index)[np.newaxis, ...])
+        if array.dtype == np.uint16:
+            # torch has no uint16. The volumes are stored as HU + 1024 <= 3072, so viewing them as
+            # int16 is exact.
+            array = array.view(np.int16)
+        with warnings.catch_warnings():
+            # The tensor wraps the read-only memory map without a copy. torch warns that it is not
+            # writable, but samples are only read.
+            warnings.simplefilter('ignore', UserWarning)
+            return torch.from_numpy(array)
+
+    def __len__(self):
+        return len(self.samples)
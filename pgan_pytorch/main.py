@@ -4,16 +4,16 @@ import numpy as np
 import random
 import argparse
 import os
+import functools
 from torch.utils.tensorboard import SummaryWriter
 from copy import deepcopy
 
-from data import DatasetFolder
+from data import VolumeDataset
 from network_dict import Generator, Discriminator
-from utils import count_parameters
+from utils import count_parameters, list_volumes
+from surfgan_staging import stage_files, wait_for_stage, BackgroundStager
 from train import train
-from distutils.dir_util import copy_tree
 import time
-import glob
 
 
 def main(args):
@@ -48,6 +48,7 @@ def main(args):
         discriminator_path = os.path.join(args.continue_path, f'discriminator_phase_{args.starting_phase - 1}.pt')
         discriminator.load_state_dict(torch.load(discriminator_path))
 
+    stager = None
     for phase in range(args.starting_phase, num_phases + 1):
         
         # Prevents horovod error.
@@ -71,25 +72,25 @@ def main(args):
         data_path = os.path.join(args.dataset_path, f'{size}x{size}/')
         scratch_path = os.path.join(args.scratch_path, f'{size}x{size}')
         if (args.horovod and hvd.local_rank() == 0) or not args.horovod:
+            if stager is not None:
+                print(f"Waited {stager.wait():.1f}s for background staging.")
+            # Only copies what the background stager has not copied yet.
             print("Copying files to scratch space.")
-            copy_tree(data_path, scratch_path, preserve_symlinks=True, update=True)
+            stage_files(list_volumes(data_path, args.file_extension), scratch_path, src_dir=data_path)
             print('Done!')
-            
-        while len(glob.glob(os.path.join(scratch_path, '*' + args.file_extension))) < len(glob.glob(os.path.join(data_path, '*' + args.file_extension))):
-            print(hvd.local_rank(), len(glob.glob(os.path.join(scratch_path, '*' + args.file_extension))), len(glob.glob(os.path.join(data_path, '*' + args.file_extension))))
-            time.sleep(1)
-        
-        assert len(glob.glob(os.path.join(scratch_path, '*' + args.file_extension))) == len(glob.glob(os.path.join(data_path, '*' + args.file_extension)))
 
-        dataset = DatasetFolder(scratch_path, 
-                               loader=lambda path: torch.from_numpy(np.load(path).astype(np.float32)),
-                               extensions=(args.file_extension,),
-                               transform=lambda x: x.unsqueeze(0) / 1024
-                               # transform=lambda x: x.float() 
-        )
+            if phase < num_phases:
+                next_size = 2 * size
+                next_path = os.path.join(args.dataset_path, f'{next_size}x{next_size}/')
+                stager = BackgroundStager(functools.partial(list_volumes, next_path, args.file_extension),
+                                          os.path.join(args.scratch_path, f'{next_size}x{next_size}'),
+                                          src_dir=next_path, bytes_per_second=args.stage_bandwidth_mb * 2 ** 20)
+
+        # Only the completion marker is checked, so the other ranks do not list the dataset.
+        wait_for_stage(scratch_path, (), src_dir=data_path)
+
+        dataset = VolumeDataset(scratch_path, extensions=(args.file_extension,))
 
-        assert len(dataset) == len(glob.glob(os.path.join(scratch_path, '*' + args.file_extension)))
-        
         print('Dataset len, min, max, shape:', len(dataset), dataset[0].min(), dataset[0].max(), dataset[0].shape)
         
         # Get DataLoader
@@ -99,7 +100,14 @@ def main(args):
             batch_size = max(1, 128 // size)
 
         print(f"Batch size: {batch_size}")
-            
+
+        # The loader lives for the whole phase; persistent workers are not respawned every epoch.
+        loader_kwargs = {'num_workers': args.num_workers, 'pin_memory': True}
+        if args.num_workers > 0:
+            loader_kwargs['persistent_workers'] = True
+            loader_kwargs['prefetch_factor'] = args.prefetch_factor
+            loader_kwargs['multiprocessing_context'] = args.worker_start_method
+
         if args.horovod:
             verbose = hvd.rank() == 0
             torch.set_num_threads(2)
@@ -107,15 +115,14 @@ def main(args):
                 dataset, num_replicas=hvd.size(), rank=hvd.rank())
             data_loader = torch.utils.data.DataLoader(
                 dataset, batch_size=batch_size,
-            sampler=train_sampler, num_workers=2, pin_memory=True)
+            sampler=train_sampler, **loader_kwargs)
 
         else:
             data_loader = torch.utils.data.DataLoader(
                 dataset,
                 batch_size=batch_size,
                 shuffle=True,
-                num_workers=4,
-                pin_memory=True)
+                **loader_kwargs)
             train_sampler = None
         
         lr_dict = {
@@ -206,6 +213,11 @@ if __name__ == '__main__':
     parser.add_argument('--fp16_allreduce', default=False, action='store_true')
     parser.add_argument('--amsgrad', default=False, action='store_true')
     parser.add_argument('--continue_path', default=None)
+    parser.add_argument('--stage_bandwidth_mb', type=float, default=0,
+                        help='Bandwidth limit in MiB/s for staging the next phase in the background, 0 for none.')
+    parser.add_argument('--num_workers', type=int, default=4)
+    parser.add_argument('--prefetch_factor', type=int, default=2)
+    parser.add_argument('--worker_start_method', type=str, default=None, choices=['fork', 'spawn', 'forkserver'])
     args = parser.parse_args()
     
     if args.horovod:
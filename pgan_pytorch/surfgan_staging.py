@@ -0,0 +1,9 @@
+"""Staging helpers shared with the 3D trainer, see SURFGAN_3D/staging.py."""
+import os
+import sys
+
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'SURFGAN_3D'))
+
+from staging import stage_files, wait_for_stage, BackgroundStager
+
+__all__ = ['stage_files', 'wait_for_stage', 'BackgroundStager']
@@ -140,7 +140,7 @@ def train_epoch(data_loader, generator, discriminator, generator_optim, discrimi
         for p in discriminator.parameters():
             p.requires_grad = True
 
-        x_real = x_real.to(discriminator.device)
+        x_real = x_real.to(discriminator.device, non_blocking=True).float() / 1024
         x_real = x_real + torch.randn_like(x_real).to(discriminator.device) * 1e-2
         z = torch.randn(x_real.shape[0], generator.latent_dim)
         x_fake = generator(z, alpha).detach()